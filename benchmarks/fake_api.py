@@ -0,0 +1,122 @@
+"""benchmarks/fake_api.py
+
+Local stand-in for the democracyonline.io ``bot?endpoint=...`` API, with
+configurable latency and error rate.
+"""
+
+import asyncio
+import random
+from collections import Counter
+
+from aiohttp import web
+
+job_names = ("Representative", "Senator", "President", "Citizen")
+
+
+class FakeAPI:
+    """Serves generated users, parties and game state over HTTP.
+
+    Args:
+        users (int): The number of users, with IDs "0" to ``users - 1``.
+        parties (int): The number of parties users are spread over.
+        latency (float): Seconds each request takes.
+        jitter (float): Random extra seconds added to each request.
+        error_rate (float): Fraction of requests answered with a 500.
+        batch (bool): Whether multi-ID ``ids=`` user requests are answered.
+        seed (int): Seed for the generated data and errors.
+    """
+
+    def __init__(
+        self,
+        users=1000,
+        parties=8,
+        latency=0.02,
+        jitter=0.0,
+        error_rate=0.0,
+        batch=True,
+        seed=0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.batch = batch
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.errors = 0
+        self.parties = {
+            str(party_id): {
+                "id": party_id,
+                "name": f"Party {party_id}",
+                "color": f"#{self.random.randrange(0x1000000):06x}",
+            }
+            for party_id in range(1, parties + 1)
+        }
+        self.users = {
+            str(user_id): {
+                "id": user_id,
+                "username": f"user{user_id}",
+                "bio": f"Bio of user {user_id}",
+                "partyId": self.random.randint(1, parties) if parties else None,
+                "role": self.random.choice(job_names),
+                "politicalLeaning": "Center",
+                "isActive": True,
+                "createdAt": "2025-01-01T00:00:00Z",
+            }
+            for user_id in range(users)
+        }
+        self.game_state = [
+            {"status": "Voting", "daysLeft": 2, "bills_voting": ["#1 - Budget"]},
+            {
+                "status": "Concluded",
+                "daysLeft": 5,
+                "bills_voting": ["#2 - Roads"],
+                "house_bills_voting": ["#3 - Parks"],
+            },
+        ]
+        self._runner = None
+        self.url = None
+
+    async def _handle(self, request):
+        endpoint = request.query.get("endpoint", "")
+        ids = request.query.get("ids")
+        self.requests[f"{endpoint}{'[batch]' if ids else ''}"] += 1
+        await asyncio.sleep(self.latency + self.random.random() * self.jitter)
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=500, text="Injected error")
+
+        if endpoint == "users" and ids is not None:
+            if not self.batch:
+                return web.Response(status=400, text="Unsupported")
+            found = [self.users[i] for i in ids.split(",") if i in self.users]
+            return web.json_response(found)
+        if endpoint == "users":
+            user = self.users.get(request.query.get("id", ""))
+            if user is None:
+                return web.Response(status=404, text="User not found")
+            return web.json_response(user)
+        if endpoint == "parties":
+            party = self.parties.get(request.query.get("id", ""))
+            if party is None:
+                return web.Response(status=404, text="Party not found")
+            return web.json_response(party)
+        if endpoint == "game-state":
+            return web.json_response(self.game_state)
+        return web.Response(status=404, text="Unknown endpoint")
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Starts serving and returns the API base url."""
+        app = web.Application()
+        app.router.add_get("/api/bot", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}/api/"
+        return self.url
+
+    async def stop(self):
+        """Stops serving."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
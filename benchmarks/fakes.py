@@ -0,0 +1,160 @@
+"""benchmarks/fakes.py
+
+Stand-ins for the discord.py objects the bot touches. Every method that
+would make a Discord API request increments ``calls`` instead.
+"""
+
+import asyncio
+import itertools
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import discord
+
+# Discord API requests made through the fakes, by method name.
+calls = Counter()
+
+_ids = itertools.count(10**17)
+
+
+class FakeRole:
+    def __init__(self, guild, name, color=None, position=1, default=False):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.color = color
+        self.position = position
+        self._default = default
+
+    def is_default(self):
+        return self._default
+
+    def __lt__(self, other):
+        return (self.position, self.id) < (other.position, other.id)
+
+    def __repr__(self):
+        return f"<FakeRole {self.name!r} position={self.position}>"
+
+
+class FakeMember:
+    def __init__(self, guild, member_id, name=None, roles=()):
+        self.id = member_id
+        self.guild = guild
+        self.name = name or f"member{member_id}"
+        self.roles = [guild.default_role, *roles]
+
+    def __str__(self):
+        return self.name
+
+    async def edit(self, roles=None, reason=None):
+        calls["member.edit"] += 1
+        if roles is not None:
+            self.roles = [self.guild.default_role, *roles]
+
+
+class FakeGuild:
+    """A guild whose members are all cached, like a chunked guild."""
+
+    def __init__(self, member_ids=(), bot_id=1):
+        self.id = next(_ids)
+        self.chunked = True
+        self.default_role = FakeRole(self, "@everyone", position=0, default=True)
+        bot_role = FakeRole(self, "Democradroid", position=1)
+        self.roles = [self.default_role, bot_role]
+        self._members = {}
+        self.me = self._add(FakeMember(self, bot_id, "Democradroid", [bot_role]))
+        self.me.top_role = bot_role
+        for member_id in member_ids:
+            self._add(FakeMember(self, member_id))
+
+    def _add(self, member):
+        self._members[member.id] = member
+        return member
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    def get_role(self, role_id):
+        return next((role for role in self.roles if role.id == role_id), None)
+
+    async def chunk(self, cache=True):
+        calls["guild.chunk"] += 1
+
+    async def fetch_member(self, member_id):
+        calls["guild.fetch_member"] += 1
+        member = self._members.get(member_id)
+        if member is None:
+            raise discord.NotFound(
+                SimpleNamespace(status=404, reason="Not Found"), "Unknown Member"
+            )
+        return member
+
+    async def create_role(self, name, color=None, **kwargs):
+        calls["guild.create_role"] += 1
+        # New roles are created just above @everyone.
+        for role in self.roles:
+            if not role.is_default():
+                role.position += 1
+        role = FakeRole(self, name, color, position=1)
+        self.roles.append(role)
+        return role
+
+    async def edit_role_positions(self, positions, reason=None):
+        calls["guild.edit_role_positions"] += 1
+        for role, position in positions.items():
+            role.position = position
+
+
+class FakeChannel:
+    def __init__(self):
+        self.id = next(_ids)
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        calls["channel.send"] += 1
+        self.sent.append(content)
+
+
+class FakeResponse:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, content=None, **kwargs):
+        calls["interaction.response"] += 1
+        self.messages.append(content if content is not None else kwargs)
+
+    async def defer(self, **kwargs):
+        calls["interaction.response"] += 1
+
+
+class FakeInteraction:
+    def __init__(self, user, guild, channel=None):
+        self.user = user
+        self.guild = guild
+        self.channel = channel or FakeChannel()
+        self.channel_id = self.channel.id
+        self.created_at = datetime.now(timezone.utc)
+        self.response = FakeResponse()
+
+    async def edit_original_response(self, **kwargs):
+        calls["interaction.edit"] += 1
+
+
+class FakeClient:
+    """Just enough of ``discord.Client`` for the job runner."""
+
+    def __init__(self, guilds, channels=()):
+        self.guilds = list(guilds)
+        self._channels = {channel.id: channel for channel in channels}
+
+    def get_guild(self, guild_id):
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id):
+        calls["client.fetch_channel"] += 1
+        await asyncio.sleep(0)
+        return self._channels[channel_id]
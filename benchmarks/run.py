@@ -0,0 +1,248 @@
+"""benchmarks/run.py
+
+Offline benchmarks for the Democradroid bot.
+
+Runs the command coroutines against a local fake democracyonline.io API and
+fake Discord objects, then reports wall time, DemocracyOnline requests,
+Discord API calls and SQLite queries per scenario. Nothing leaves the
+machine and the real database is never touched. From the repository root:
+
+    python -m benchmarks.run --users 10000 --latency 0.02
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import database as db
+import democradroid as dd
+import dofuncs as do
+import jobs
+import mutations
+
+from benchmarks import fakes
+from benchmarks.fake_api import FakeAPI
+
+scenarios = ("verify", "whoami", "whois", "assign_party_role", "processpartyroles")
+
+
+class Env:
+    """The fake API, guild and database shared by the scenarios."""
+
+    def __init__(self, api, guild, verified, unverified):
+        self.api = api
+        self.guild = guild
+        # (Discord ID, DemocracyOnline ID) pairs.
+        self.verified = verified
+        self.unverified = unverified
+        self.queries = 0
+
+    def count_query(self, statement):
+        self.queries += 1
+
+    def snapshot(self):
+        return (
+            time.perf_counter(),
+            Counter(self.api.requests),
+            Counter(fakes.calls),
+            self.queries,
+        )
+
+
+def report(env, name, commands, before):
+    """Prints one result line, with counts per command."""
+    started, requests, calls, queries = before
+    elapsed = time.perf_counter() - started
+    requests = Counter(env.api.requests) - requests
+    calls = Counter(fakes.calls) - calls
+    queries = env.queries - queries
+
+    def per(count):
+        return f"{count / commands:.2f}" if commands else "-"
+
+    print(
+        f"{name:<20} {commands:>7} {elapsed:>9.2f}s "
+        f"{elapsed * 1000 / max(commands, 1):>9.2f}ms "
+        f"{per(sum(requests.values())):>8} {per(sum(calls.values())):>8} "
+        f"{per(queries):>8}"
+    )
+    for label, counter in (("DO API", requests), ("Discord", calls)):
+        if counter:
+            detail = ", ".join(f"{key} {n}" for key, n in sorted(counter.items()))
+            print(f"{'':<20} {label}: {detail}")
+
+
+async def bench_verify(env, count):
+    # First /verify hands out a code, the second finds it in the bio.
+    for discord_id, democracyonline_id in env.unverified[:count]:
+        member = env.guild._add(fakes.FakeMember(env.guild, discord_id))
+        await dd.verify.callback(
+            fakes.FakeInteraction(member, env.guild), int(democracyonline_id)
+        )
+        code = db.get_user_by_discord_id(str(discord_id))[4]
+        env.api.users[democracyonline_id]["bio"] += f" {code}"
+        await dd.verify.callback(
+            fakes.FakeInteraction(member, env.guild), int(democracyonline_id)
+        )
+    return count * 2
+
+
+async def bench_whoami(env, count):
+    for discord_id, _ in env.verified[:count]:
+        member = env.guild.get_member(discord_id)
+        await dd.whoami.callback(fakes.FakeInteraction(member, env.guild))
+    return count
+
+
+async def bench_whois(env, count):
+    invoker = env.guild.me
+    for discord_id, _ in env.verified[-count:]:
+        target = env.guild.get_member(discord_id)
+        await dd.whois.callback(fakes.FakeInteraction(invoker, env.guild), target)
+    return count
+
+
+async def bench_assign_party_role(env, count):
+    for discord_id, democracyonline_id in env.verified[:count]:
+        await dd.assign_party_role(env.guild, str(discord_id), democracyonline_id)
+    return count
+
+
+async def bench_processpartyroles(env, count):
+    # The whole job, over every verified user, as the job runner runs it.
+    channel = fakes.FakeChannel()
+    runner = jobs.JobRunner(
+        fakes.FakeClient([env.guild], [channel]),
+        {"party_roles": dd.party_roles_job},
+        dd.mutation_queue,
+    )
+    job_id = runner.submit(
+        "party_roles", env.guild.id, channel.id, {"concurrency": dd.bulk_concurrency}
+    )
+    runner.start()
+    while db.get_job(job_id)["status"] in jobs.ACTIVE:
+        await asyncio.sleep(0.05)
+    runner.stop()
+    job = db.get_job(job_id)
+    return job["succeeded"] + job["skipped"] + job["failed"]
+
+
+async def setup(args):
+    api = FakeAPI(
+        users=args.users + args.commands,
+        parties=args.parties,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        batch=not args.no_batch,
+    )
+    do.base_url = await api.start()
+    if not args.rate_limits:
+        # Measure the bot, not the local token buckets.
+        mutations.route_limits = {
+            route: (10**9, 1.0) for route in mutations.route_limits
+        }
+
+    db.init_db()
+    member_id = 10**17
+    verified = [(member_id + i, str(i)) for i in range(args.users)]
+    unverified = [
+        (member_id + i, str(i)) for i in range(args.users, args.users + args.commands)
+    ]
+    conn = db.get_connection()
+    conn.executemany(
+        "INSERT INTO users (id, discord_id, democracyonline_id, verified) "
+        "VALUES (?, ?, ?, 1)",
+        [(f"u{i:08d}", str(d), o) for i, (d, o) in enumerate(verified)],
+    )
+    conn.commit()
+
+    guild = fakes.FakeGuild([discord_id for discord_id, _ in verified])
+    # whois compares its target with the bot's own user.
+    dd.client._connection.user = SimpleNamespace(id=guild.me.id)
+    env = Env(api, guild, verified, unverified)
+    conn.set_trace_callback(env.count_query)
+    return env
+
+
+async def run(args):
+    env = await setup(args)
+    print(
+        f"{args.users} verified users, {args.parties} parties, "
+        f"{args.latency * 1000:.0f}ms API latency, {args.error_rate:.0%} errors"
+    )
+    print(
+        f"{'scenario':<20} {'commands':>7} {'wall':>10} {'per cmd':>11} "
+        f"{'DO/cmd':>8} {'DC/cmd':>8} {'SQL/cmd':>8}"
+    )
+    try:
+        for name in args.scenarios:
+            before = env.snapshot()
+            # The commands print diagnostics; keep them out of the report.
+            quiet = contextlib.redirect_stdout(io.StringIO())
+            with contextlib.nullcontext() if args.verbose else quiet:
+                commands = await globals()[f"bench_{name}"](env, args.commands)
+            report(env, name, commands, before)
+    finally:
+        await do.close()
+        await env.api.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the offline benchmarks.")
+    parser.add_argument("--users", type=int, default=10000, help="Verified users")
+    parser.add_argument("--parties", type=int, default=8, help="Parties")
+    parser.add_argument(
+        "--commands", type=int, default=100, help="Invocations per command scenario"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Seconds per API request"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Random extra seconds per request"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Fraction of failed requests"
+    )
+    parser.add_argument(
+        "--no-batch",
+        action="store_true",
+        help="Make the API reject multi-ID user requests",
+    )
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="Keep the mutation queue's Discord rate limits",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show what the commands print"
+    )
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=scenarios,
+        default=list(scenarios),
+        help="Scenarios to run",
+    )
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="democradroid-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        asyncio.run(run(args))
+    finally:
+        os.chdir(cwd)
+        db.close_connections()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
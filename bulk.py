@@ -0,0 +1,103 @@
+"""bulk.py
+
+This module runs bulk operations over many items with bounded concurrency
+for the Democradroid bot.
+"""
+
+import asyncio
+import time
+
+
+class Skip(Exception):
+    """Raised by a bulk worker to mark an item as skipped rather than failed."""
+
+
+class BulkResult:
+    """Counters collected while a bulk operation runs.
+
+    Args:
+        total (int): The number of items to process.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.succeeded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+        self.started = time.monotonic()
+
+    @property
+    def done(self):
+        return self.succeeded + self.skipped + self.failed
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def progress(self):
+        """Returns a one-line progress report."""
+        return (
+            f"Processed {self.done}/{self.total} "
+            f"({self.succeeded} ok, {self.skipped} skipped, {self.failed} failed)"
+        )
+
+    def summary(self, max_errors=5):
+        """Returns a final report, including the first few failures.
+
+        Args:
+            max_errors (int): The number of failures to list.
+        """
+        lines = [f"{self.progress()} in {self.elapsed:.1f}s."]
+        for item, error in self.errors[:max_errors]:
+            lines.append(f"- {item}: {error}")
+        if len(self.errors) > max_errors:
+            lines.append(f"- ...and {len(self.errors) - max_errors} more")
+        return "\n".join(lines)
+
+
+async def run_bulk(items, worker, concurrency=8, label=None):
+    """Runs a worker coroutine over every item with bounded concurrency.
+
+    The worker succeeds by returning, skips an item by raising ``Skip`` and
+    fails it by raising anything else. Failures are recorded, never raised.
+
+    Args:
+        items (list): The items to process.
+        worker (callable): Coroutine function taking a single item.
+        concurrency (int): The maximum number of items processed at once.
+        label (callable): Optional function naming an item in error reports.
+    Returns:
+        BulkResult: The final counters.
+    """
+    items = list(items)
+    result = BulkResult(len(items))
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+
+    async def run_worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await worker(item)
+                result.succeeded += 1
+            except Skip:
+                result.skipped += 1
+            except Exception as e:
+                result.failed += 1
+                result.errors.append((label(item) if label else item, repr(e)))
+
+    workers = [
+        asyncio.create_task(run_worker())
+        for _ in range(max(1, min(concurrency, len(items))))
+    ]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+    return result
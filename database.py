@@ -3,20 +3,97 @@
 This module handles database interactions for the Democradroid bot.
 """
 
+import functools
+import json
+import os
 import sqlite3
+import threading
+import time
 
+import metrics
 
-def init_db(db_name="democradroid.db"):
-    """Initializes the database and creates necessary tables if they don't exist.
+# Number of prepared statements each connection keeps compiled.
+statement_cache_size = 128
+# Seconds a verification code stays valid unless the caller says otherwise.
+verification_code_ttl = 3600
+
+_connections = {}
+_lock = threading.RLock()
+
+
+def get_connection(db_name="democradroid.db"):
+    """Returns the persistent connection for a database file.
+
+    The connection is opened on first use and reused for every later call in
+    the same process. It runs in WAL mode with ``synchronous=NORMAL`` so
+    readers never block the writer and commits skip the extra fsync.
 
     Args:
         db_name (str): The name of the database file.
+    Returns:
+        sqlite3.Connection: The connection.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
+    with _lock:
+        entry = _connections.get(db_name)
+        # A connection inherited across fork() must not be reused.
+        if entry is not None and entry[1] == os.getpid():
+            return entry[0]
+        conn = sqlite3.connect(
+            db_name,
+            check_same_thread=False,
+            cached_statements=statement_cache_size,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _connections[db_name] = (conn, os.getpid())
+        return conn
+
+
+def close_connections():
+    """Closes every connection opened by this process."""
+    with _lock:
+        for conn, pid in _connections.values():
+            if pid == os.getpid():
+                conn.close()
+        _connections.clear()
+
+
+def _timed(func):
+    # Records the wall time of each call in metrics.db_seconds.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.db_seconds.observe(
+                time.perf_counter() - started, function=func.__name__
+            )
+
+    return wrapper
+
 
+def _execute(db_name, query, params=()):
+    # Runs a write statement and commits it.
+    with _lock:
+        conn = get_connection(db_name)
+        conn.execute(query, params)
+        conn.commit()
+
+
+def _fetchone(db_name, query, params=()):
+    with _lock:
+        return get_connection(db_name).execute(query, params).fetchone()
+
+
+def _fetchall(db_name, query, params=()):
+    with _lock:
+        return get_connection(db_name).execute(query, params).fetchall()
+
+
+def _migrate_base_tables(conn):
     # Create a table for users
-    cursor.execute(
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS users (
             id TEXT PRIMARY KEY,
@@ -28,7 +105,7 @@ def init_db(db_name="democradroid.db"):
     """
     )
 
-    cursor.execute(
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS parties (
             democracyonline_id TEXT,
@@ -38,10 +115,315 @@ def init_db(db_name="democradroid.db"):
         """
     )
 
-    conn.commit()
-    conn.close()
 
+def _migrate_lookup_indexes(conn):
+    # Keep one link per Discord user, preferring verified and newer rows.
+    # NULL IDs never clash in a unique index, so those rows are left alone.
+    conn.execute(
+        """
+        DELETE FROM users WHERE discord_id IS NOT NULL AND rowid NOT IN (
+            SELECT rowid FROM (
+                SELECT rowid, ROW_NUMBER() OVER (
+                    PARTITION BY discord_id ORDER BY verified DESC, rowid DESC
+                ) AS rank
+                FROM users WHERE discord_id IS NOT NULL
+            ) WHERE rank = 1
+        )
+        """
+    )
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_discord_id ON users (discord_id)"
+    )
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_verified
+        ON users (verified) WHERE verified = 1
+        """
+    )
+
+    # Keep the newest role mapping per (guild, party) pair.
+    conn.execute(
+        """
+        DELETE FROM parties
+        WHERE guild_id IS NOT NULL AND democracyonline_id IS NOT NULL
+          AND rowid NOT IN (
+            SELECT MAX(rowid) FROM parties
+            WHERE guild_id IS NOT NULL AND democracyonline_id IS NOT NULL
+            GROUP BY guild_id, democracyonline_id
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_parties_guild_party
+        ON parties (guild_id, democracyonline_id)
+        """
+    )
+
+
+def _migrate_user_state(conn):
+    # Last-known DemocracyOnline party and job per user, for the sync daemon.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id TEXT PRIMARY KEY,
+            party_id TEXT,
+            role TEXT,
+            checked_at REAL
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_state_checked_at ON user_state (checked_at)"
+    )
+
+
+def _migrate_game_updates(conn):
+    # Channels subscribed to the daily game-state update.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS game_updates (
+            channel_id TEXT PRIMARY KEY,
+            guild_id TEXT,
+            role_id TEXT,
+            post_time TEXT NOT NULL
+        )
+        """
+    )
+
+
+def _migrate_game_snapshots(conn):
+    # Game state as last announced per post time, to post changes only.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS game_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            slot TEXT NOT NULL,
+            taken_at REAL NOT NULL,
+            data TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_game_snapshots_slot ON game_snapshots (slot, id)"
+    )
+    conn.execute(
+        "ALTER TABLE game_updates ADD COLUMN show_changes INTEGER NOT NULL DEFAULT 1"
+    )
+
+
+def _migrate_jobs(conn):
+    # Persisted background jobs and their checkpoints
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            guild_id TEXT NOT NULL,
+            channel_id TEXT,
+            params TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'queued',
+            cursor TEXT,
+            total INTEGER NOT NULL DEFAULT 0,
+            succeeded INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            errors TEXT NOT NULL DEFAULT '[]',
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)")
+
+
+def _migrate_shard_scopes(conn):
+    # Named leases held by one process at a time, for singleton tasks
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """
+    )
+    # Sync state is tracked per shard scope, since each process only applies
+    # roles in the guilds of its own shards.
+    conn.execute(
+        """
+        CREATE TABLE user_state_scoped (
+            user_id TEXT NOT NULL,
+            scope TEXT NOT NULL DEFAULT 'all',
+            party_id TEXT,
+            role TEXT,
+            checked_at REAL,
+            PRIMARY KEY (user_id, scope)
+        )
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO user_state_scoped (user_id, party_id, role, checked_at)
+        SELECT user_id, party_id, role, checked_at FROM user_state
+        """
+    )
+    conn.execute("DROP TABLE user_state")
+    conn.execute("ALTER TABLE user_state_scoped RENAME TO user_state")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_state_checked_at "
+        "ON user_state (scope, checked_at)"
+    )
+
+
+def _migrate_sync_tasks(conn):
+    # Durable queue of role syncs handed from the gateway to worker processes
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            guild_id TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires REAL,
+            available_at REAL NOT NULL,
+            created_at REAL NOT NULL,
+            error TEXT
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sync_tasks_status "
+        "ON sync_tasks (status, available_at)"
+    )
+    # At most one pending task per user, guild and reason
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_sync_tasks_pending "
+        "ON sync_tasks (user_id, guild_id, reason) WHERE status = 'pending'"
+    )
+
+
+def _migrate_verification_expiry(conn):
+    # Pending verification codes expire, and remember where /verify was used
+    for column in (
+        "code_created_at REAL",
+        "code_expires_at REAL",
+        "code_checked_at REAL",
+        "code_guild_id TEXT",
+        "code_channel_id TEXT",
+    ):
+        conn.execute(f"ALTER TABLE users ADD COLUMN {column}")
+    # Codes handed out before codes expired get a day from now
+    conn.execute(
+        """
+        UPDATE users SET
+            code_created_at = CAST(strftime('%s', 'now') AS REAL),
+            code_expires_at = CAST(strftime('%s', 'now') AS REAL) + 86400
+        WHERE verified = 0 AND verification_code IS NOT NULL
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_code_expires_at ON users "
+        "(code_expires_at) WHERE verified = 0 AND verification_code IS NOT NULL"
+    )
+
+
+def _migrate_profile_cache(conn):
+    # Last fetched DemocracyOnline users and parties, kept across restarts
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS profile_cache (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (kind, key)
+        )
+        """
+    )
+
+
+def _migrate_meta(conn):
+    # Small key/value settings the bot keeps between runs
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """
+    )
+
+
+# Ordered schema migrations. A migration's version is its position in the
+# list, starting at 1. Append new migrations; never reorder or edit old ones.
+MIGRATIONS = [
+    _migrate_base_tables,
+    _migrate_lookup_indexes,
+    _migrate_user_state,
+    _migrate_game_updates,
+    _migrate_game_snapshots,
+    _migrate_jobs,
+    _migrate_shard_scopes,
+    _migrate_sync_tasks,
+    _migrate_verification_expiry,
+    _migrate_profile_cache,
+    _migrate_meta,
+]
 
+
+@_timed
+def get_schema_version(db_name="democradroid.db"):
+    """Retrieves the schema version the database has been migrated to.
+
+    Args:
+        db_name (str): The name of the database file.
+    Returns:
+        int: The schema version, or 0 for a fresh database.
+    """
+    with _lock:
+        conn = get_connection(db_name)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"
+        )
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+@_timed
+def init_db(db_name="democradroid.db"):
+    """Initializes the database by applying any pending schema migrations.
+
+    Each migration runs in its own transaction together with the bump of
+    ``schema_version``, so an interrupted upgrade resumes where it stopped.
+
+    Args:
+        db_name (str): The name of the database file.
+    """
+    with _lock:
+        conn = get_connection(db_name)
+        current = get_schema_version(db_name)
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            if version <= current:
+                continue
+            conn.execute("BEGIN")
+            try:
+                migration(conn)
+                conn.execute("DELETE FROM schema_version")
+                conn.execute(
+                    "INSERT INTO schema_version (version) VALUES (?)", (version,)
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+
+@_timed
 def add_user(user_id, discord_id, democracyonline_id, db_name="democradroid.db"):
     """Adds a new user to the database.
 
@@ -51,10 +433,8 @@ def add_user(user_id, discord_id, democracyonline_id, db_name="democradroid.db")
         democracyonline_id (str): The DemocracyOnline ID of the user.
         db_name (str): The name of the database file.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(
+    _execute(
+        db_name,
         """
         INSERT INTO users (id, discord_id, democracyonline_id)
         VALUES (?, ?, ?)
@@ -62,10 +442,8 @@ def add_user(user_id, discord_id, democracyonline_id, db_name="democradroid.db")
         (user_id, discord_id, democracyonline_id),
     )
 
-    conn.commit()
-    conn.close()
-
 
+@_timed
 def get_user(user_id, db_name="democradroid.db"):
     """Retrieves a user from the database.
 
@@ -75,21 +453,17 @@ def get_user(user_id, db_name="democradroid.db"):
     Returns:
         tuple: The user data.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(
+    user = _fetchone(
+        db_name,
         """
         SELECT * FROM users WHERE id = ?
     """,
         (user_id,),
     )
-    user = cursor.fetchone()
-
-    conn.close()
     return user
 
 
+@_timed
 def get_user_by_discord_id(discord_id, db_name="democradroid.db"):
     """Retrieves a user from the database by their Discord ID.
 
@@ -99,43 +473,57 @@ def get_user_by_discord_id(discord_id, db_name="democradroid.db"):
     Returns:
         tuple: The user data.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(
+    user = _fetchone(
+        db_name,
         """
         SELECT * FROM users WHERE discord_id = ?
     """,
         (discord_id,),
     )
-    user = cursor.fetchone()
-
-    conn.close()
     return user
 
 
-def add_verification_code(user_id, code, db_name="democradroid.db"):
-    """Adds a verification code for a user.
+@_timed
+def add_verification_code(
+    user_id,
+    code,
+    db_name="democradroid.db",
+    *,
+    created_at=None,
+    expires_at=None,
+    guild_id=None,
+    channel_id=None,
+):
+    """Adds a verification code for a user, replacing any earlier one.
 
     Args:
         user_id (str): The unique ID for the user.
         code (str): The verification code.
         db_name (str): The name of the database file.
+        created_at (float): The UNIX time the code was handed out. Defaults
+            to now.
+        expires_at (float): The UNIX time the code stops being accepted.
+            Defaults to ``verification_code_ttl`` seconds after ``created_at``.
+        guild_id (str): The Discord ID of the guild /verify was used in.
+        channel_id (str): The Discord ID of the channel /verify was used in.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(
+    if created_at is None:
+        created_at = time.time()
+    if expires_at is None:
+        expires_at = created_at + verification_code_ttl
+    _execute(
+        db_name,
         """
-        UPDATE users SET verification_code = ? WHERE id = ?
+        UPDATE users SET verification_code = ?, code_created_at = ?,
+            code_expires_at = ?, code_checked_at = NULL, code_guild_id = ?,
+            code_channel_id = ?
+        WHERE id = ?
     """,
-        (code, user_id),
+        (code, created_at, expires_at, guild_id, channel_id, user_id),
     )
 
-    conn.commit()
-    conn.close()
-
 
+@_timed
 def set_user_verified(user_id, db_name="democradroid.db"):
     """Sets a user as verified.
 
@@ -143,20 +531,16 @@ def set_user_verified(user_id, db_name="democradroid.db"):
         user_id (str): The unique ID for the user.
         db_name (str): The name of the database file.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(
+    _execute(
+        db_name,
         """
         UPDATE users SET verified = 1 WHERE id = ?
     """,
         (user_id,),
     )
 
-    conn.commit()
-    conn.close()
-
 
+@_timed
 def delete_user(user_id, db_name="democradroid.db"):
     """Deletes a user from the database.
 
@@ -164,20 +548,17 @@ def delete_user(user_id, db_name="democradroid.db"):
         user_id (str): The unique ID for the user.
         db_name (str): The name of the database file.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(
+    _execute(
+        db_name,
         """
         DELETE FROM users WHERE id = ?
     """,
         (user_id,),
     )
-
-    conn.commit()
-    conn.close()
+    _execute(db_name, "DELETE FROM user_state WHERE user_id = ?", (user_id,))
 
 
+@_timed
 def get_party_role(party_id, guild_id, db_name="democradroid.db"):
     """Retrieves the Discord role ID for a given party.
 
@@ -187,21 +568,17 @@ def get_party_role(party_id, guild_id, db_name="democradroid.db"):
     Returns:
         str: The Discord role ID.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(
+    role = _fetchone(
+        db_name,
         """
         SELECT discord_role_id FROM parties WHERE democracyonline_id = ? and guild_id = ?
         """,
         (party_id, guild_id),
     )
-    role = cursor.fetchone()
-
-    conn.close()
     return role[0] if role else None
 
 
+@_timed
 def list_party_roles(guild_id, db_name="democradroid.db"):
     """Retrieves all party roles for a given guild.
 
@@ -211,21 +588,17 @@ def list_party_roles(guild_id, db_name="democradroid.db"):
     Returns:
         list: A list of tuples containing party IDs and their corresponding Discord role IDs.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(
+    roles = _fetchall(
+        db_name,
         """
         SELECT democracyonline_id, discord_role_id FROM parties WHERE guild_id = ?
         """,
         (guild_id,),
     )
-    roles = cursor.fetchall()
-
-    conn.close()
     return roles
 
 
+@_timed
 def add_party_role(party_id, discord_role_id, guild_id, db_name="democradroid.db"):
     """Adds or updates the Discord role ID for a given party.
 
@@ -234,21 +607,17 @@ def add_party_role(party_id, discord_role_id, guild_id, db_name="democradroid.db
         discord_role_id (str): The Discord role ID.
         db_name (str): The name of the database file.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(
+    _execute(
+        db_name,
         """
-        INSERT INTO parties (democracyonline_id, discord_role_id, guild_id)
+        INSERT OR REPLACE INTO parties (democracyonline_id, discord_role_id, guild_id)
         VALUES (?, ?, ?)
     """,
         (party_id, discord_role_id, guild_id),
     )
 
-    conn.commit()
-    conn.close()
-
 
+@_timed
 def remove_party_role(party_id, guild_id, db_name="democradroid.db"):
     """Removes the Discord role ID for a given party.
 
@@ -257,20 +626,16 @@ def remove_party_role(party_id, guild_id, db_name="democradroid.db"):
         guild_id (str): The Discord guild ID.
         db_name (str): The name of the database file.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(
+    _execute(
+        db_name,
         """
         DELETE FROM parties WHERE democracyonline_id = ? AND guild_id = ?
     """,
         (party_id, guild_id),
     )
 
-    conn.commit()
-    conn.close()
-
 
+@_timed
 def get_all_verified_users(db_name="democradroid.db"):
     """Retrieves all verified users from the database.
 
@@ -279,15 +644,752 @@ def get_all_verified_users(db_name="democradroid.db"):
     Returns:
         list: A list of verified users.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    cursor.execute(
+    users = _fetchall(
+        db_name,
         """
         SELECT * FROM users WHERE verified = 1
     """
     )
-    users = cursor.fetchall()
+    return users
+
+
+@_timed
+def get_users_to_sync(limit, scope="all", db_name="democradroid.db"):
+    """Retrieves the verified users whose state was checked least recently.
+
+    Users that have never been checked in the scope come first.
+
+    Args:
+        limit (int): The maximum number of users to return.
+        scope (str): The shard scope the state is tracked for.
+        db_name (str): The name of the database file.
+    Returns:
+        list: Tuples of user ID, Discord ID, DemocracyOnline ID, last-known
+        party ID, last-known role and the time they were last checked.
+    """
+    users = _fetchall(
+        db_name,
+        """
+        SELECT users.id, users.discord_id, users.democracyonline_id,
+               user_state.party_id, user_state.role, user_state.checked_at
+        FROM users LEFT JOIN user_state
+            ON user_state.user_id = users.id AND user_state.scope = ?
+        WHERE users.verified = 1
+        ORDER BY COALESCE(user_state.checked_at, 0)
+        LIMIT ?
+    """,
+        (scope, limit),
+    )
+    return users
+
+
+@_timed
+def set_user_state(
+    user_id, party_id, role, checked_at, scope="all", db_name="democradroid.db"
+):
+    """Stores the last-known DemocracyOnline party and role of a user.
+
+    Args:
+        user_id (str): The unique ID for the user.
+        party_id (str): The DemocracyOnline party ID, or None.
+        role (str): The DemocracyOnline job, or None.
+        checked_at (float): The UNIX time the user was checked.
+        scope (str): The shard scope the state is tracked for.
+        db_name (str): The name of the database file.
+    """
+    _execute(
+        db_name,
+        """
+        INSERT OR REPLACE INTO user_state (user_id, scope, party_id, role, checked_at)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+        (user_id, scope, party_id, role, checked_at),
+    )
+
+
+@_timed
+def reset_user_state(user_id, db_name="democradroid.db"):
+    """Forgets the last-known party and role of a user in every scope.
+
+    The role-sync daemon then sees a change the next time it checks the
+    user, without moving them ahead in the queue.
+
+    Args:
+        user_id (str): The unique ID for the user.
+        db_name (str): The name of the database file.
+    """
+    _execute(
+        db_name,
+        """
+        UPDATE user_state SET party_id = NULL, role = NULL WHERE user_id = ?
+    """,
+        (user_id,),
+    )
+
+
+@_timed
+def add_game_update(
+    channel_id,
+    guild_id,
+    role_id,
+    post_time,
+    show_changes=True,
+    db_name="democradroid.db",
+):
+    """Adds or updates a channel's game-state update subscription.
+
+    Args:
+        channel_id (str): The Discord channel ID to post in.
+        guild_id (str): The Discord guild ID of the channel.
+        role_id (str): The Discord role ID to ping, or None.
+        post_time (str): The UTC time to post at, as "HH:MM".
+        show_changes (bool): Whether to add a "what changed" embed.
+        db_name (str): The name of the database file.
+    """
+    _execute(
+        db_name,
+        """
+        INSERT OR REPLACE INTO game_updates
+            (channel_id, guild_id, role_id, post_time, show_changes)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+        (channel_id, guild_id, role_id, post_time, int(show_changes)),
+    )
+
+
+@_timed
+def remove_game_update(channel_id, db_name="democradroid.db"):
+    """Removes a channel's game-state update subscription.
+
+    Args:
+        channel_id (str): The Discord channel ID.
+        db_name (str): The name of the database file.
+    """
+    _execute(
+        db_name,
+        """
+        DELETE FROM game_updates WHERE channel_id = ?
+    """,
+        (channel_id,),
+    )
+
+
+@_timed
+def list_game_updates(db_name="democradroid.db"):
+    """Retrieves all game-state update subscriptions.
+
+    Args:
+        db_name (str): The name of the database file.
+    Returns:
+        list: Tuples of channel ID, guild ID, role ID, post time and whether
+        to show changes.
+    """
+    updates = _fetchall(
+        db_name,
+        """
+        SELECT channel_id, guild_id, role_id, post_time, show_changes
+        FROM game_updates
+    """
+    )
+    return updates
+
+
+@_timed
+def add_game_snapshot(slot, data, taken_at, keep=10, db_name="democradroid.db"):
+    """Stores the game state announced for a post time.
+
+    Only the newest ``keep`` snapshots of the slot are kept.
+
+    Args:
+        slot (str): The "HH:MM" post time the snapshot belongs to.
+        data (dict): The game state data.
+        taken_at (float): The UNIX time the data was fetched.
+        keep (int): The number of snapshots kept per slot.
+        db_name (str): The name of the database file.
+    """
+    _execute(
+        db_name,
+        """
+        INSERT INTO game_snapshots (slot, taken_at, data) VALUES (?, ?, ?)
+    """,
+        (slot, taken_at, json.dumps(data)),
+    )
+    _execute(
+        db_name,
+        """
+        DELETE FROM game_snapshots WHERE slot = ? AND id NOT IN (
+            SELECT id FROM game_snapshots WHERE slot = ? ORDER BY id DESC LIMIT ?
+        )
+    """,
+        (slot, slot, keep),
+    )
+
+
+@_timed
+def get_latest_game_snapshot(slot, db_name="democradroid.db"):
+    """Retrieves the game state last announced for a post time.
+
+    Args:
+        slot (str): The "HH:MM" post time.
+        db_name (str): The name of the database file.
+    Returns:
+        dict: The game state data, or None if nothing was announced yet.
+    """
+    snapshot = _fetchone(
+        db_name,
+        """
+        SELECT data FROM game_snapshots WHERE slot = ? ORDER BY id DESC LIMIT 1
+    """,
+        (slot,),
+    )
+    return json.loads(snapshot[0]) if snapshot else None
+
+
+@_timed
+def get_verified_users_page(after, limit, db_name="democradroid.db"):
+    """Retrieves verified users in user ID order, starting after a cursor.
 
-    conn.close()
+    Args:
+        after (str): The user ID to continue after, or None to start over.
+        limit (int): The maximum number of users to return.
+        db_name (str): The name of the database file.
+    Returns:
+        list: Up to ``limit`` verified users.
+    """
+    users = _fetchall(
+        db_name,
+        """
+        SELECT * FROM users WHERE verified = 1 AND id > ? ORDER BY id LIMIT ?
+    """,
+        (after if after is not None else "", limit),
+    )
     return users
+
+
+@_timed
+def count_verified_users(db_name="democradroid.db"):
+    """Counts the verified users.
+
+    Args:
+        db_name (str): The name of the database file.
+    Returns:
+        int: The number of verified users.
+    """
+    return _fetchone(db_name, "SELECT COUNT(*) FROM users WHERE verified = 1")[0]
+
+
+_job_columns = (
+    "id",
+    "kind",
+    "guild_id",
+    "channel_id",
+    "params",
+    "status",
+    "cursor",
+    "total",
+    "succeeded",
+    "skipped",
+    "failed",
+    "errors",
+    "error",
+    "created_at",
+    "updated_at",
+)
+
+
+def _job(row):
+    if row is None:
+        return None
+    job = dict(zip(_job_columns, row))
+    job["params"] = json.loads(job["params"])
+    job["errors"] = json.loads(job["errors"])
+    return job
+
+
+@_timed
+def add_job(kind, guild_id, channel_id, params, created_at, db_name="democradroid.db"):
+    """Queues a background job.
+
+    Args:
+        kind (str): The job type, a key of the runner's handlers.
+        guild_id (str): The Discord ID of the guild the job works on.
+        channel_id (str): The Discord ID of the channel to report to.
+        params (dict): JSON-serialisable job parameters.
+        created_at (float): The UNIX time the job was queued.
+        db_name (str): The name of the database file.
+    Returns:
+        int: The job ID.
+    """
+    with _lock:
+        conn = get_connection(db_name)
+        cursor = conn.execute(
+            """
+            INSERT INTO jobs (kind, guild_id, channel_id, params, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """,
+            (kind, guild_id, channel_id, json.dumps(params), created_at, created_at),
+        )
+        conn.commit()
+    return cursor.lastrowid
+
+
+@_timed
+def get_job(job_id, db_name="democradroid.db"):
+    """Retrieves a job.
+
+    Args:
+        job_id (int): The job ID.
+        db_name (str): The name of the database file.
+    Returns:
+        dict: The job's columns, with ``params`` and ``errors`` decoded, or
+        None if there is no such job.
+    """
+    row = _fetchone(
+        db_name,
+        f"SELECT {', '.join(_job_columns)} FROM jobs WHERE id = ?",
+        (job_id,),
+    )
+    return _job(row)
+
+
+@_timed
+def list_jobs(statuses=None, limit=None, db_name="democradroid.db"):
+    """Retrieves jobs, newest first.
+
+    Args:
+        statuses (tuple): Only return jobs in one of these statuses.
+        limit (int): The maximum number of jobs to return.
+        db_name (str): The name of the database file.
+    Returns:
+        list: Jobs as returned by ``get_job``.
+    """
+    query = f"SELECT {', '.join(_job_columns)} FROM jobs"
+    params = []
+    if statuses:
+        query += f" WHERE status IN ({', '.join('?' for _ in statuses)})"
+        params.extend(statuses)
+    query += " ORDER BY id DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return [_job(row) for row in _fetchall(db_name, query, params)]
+
+
+@_timed
+def set_job_status(
+    job_id, status, updated_at, error=None, only_from=None, db_name="democradroid.db"
+):
+    """Changes the status of a job.
+
+    Args:
+        job_id (int): The job ID.
+        status (str): "queued", "running", "done", "failed" or "cancelled".
+        updated_at (float): The UNIX time of the change.
+        error (str): Why the job failed, if it did.
+        only_from (tuple): If given, the job is only changed while its
+            status is one of these, so a concurrent cancel is not lost.
+        db_name (str): The name of the database file.
+    Returns:
+        bool: True if the job was changed.
+    """
+    query = "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?"
+    params = [status, error, updated_at, job_id]
+    if only_from is not None:
+        query += f" AND status IN ({', '.join('?' for _ in only_from)})"
+        params.extend(only_from)
+    with _lock:
+        conn = get_connection(db_name)
+        cursor = conn.execute(query, params)
+        conn.commit()
+    return cursor.rowcount > 0
+
+
+@_timed
+def checkpoint_job(
+    job_id,
+    cursor,
+    total,
+    succeeded,
+    skipped,
+    failed,
+    errors,
+    updated_at,
+    db_name="democradroid.db",
+):
+    """Records the progress of a running job.
+
+    Args:
+        job_id (int): The job ID.
+        cursor (str): The ID of the last user processed.
+        total (int): The number of users the job covers.
+        succeeded (int): Users processed successfully so far.
+        skipped (int): Users skipped so far.
+        failed (int): Users that failed so far.
+        errors (list): The first few failures as (label, error) pairs.
+        updated_at (float): The UNIX time of the checkpoint.
+        db_name (str): The name of the database file.
+    """
+    _execute(
+        db_name,
+        """
+        UPDATE jobs SET cursor = ?, total = ?, succeeded = ?, skipped = ?,
+            failed = ?, errors = ?, updated_at = ?
+        WHERE id = ?
+    """,
+        (
+            cursor,
+            total,
+            succeeded,
+            skipped,
+            failed,
+            json.dumps(errors),
+            updated_at,
+            job_id,
+        ),
+    )
+
+
+@_timed
+def acquire_lease(name, owner, ttl, now, db_name="democradroid.db"):
+    """Takes or renews a named lease.
+
+    The lease is granted if it is free, expired or already held by the owner.
+
+    Args:
+        name (str): The lease name.
+        owner (str): A string identifying the calling process.
+        ttl (float): Seconds the lease stays valid without renewal.
+        now (float): The current UNIX time.
+        db_name (str): The name of the database file.
+    Returns:
+        bool: True if the owner holds the lease.
+    """
+    with _lock:
+        conn = get_connection(db_name)
+        cursor = conn.execute(
+            """
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE
+            SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+        """,
+            (name, owner, now + ttl, now),
+        )
+        conn.commit()
+    return cursor.rowcount > 0
+
+
+@_timed
+def release_lease(name, owner, db_name="democradroid.db"):
+    """Gives up a lease, if the owner holds it.
+
+    Args:
+        name (str): The lease name.
+        owner (str): A string identifying the calling process.
+        db_name (str): The name of the database file.
+    """
+    _execute(
+        db_name, "DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner)
+    )
+
+
+@_timed
+def enqueue_sync_task(user_id, guild_id, reason, now, db_name="democradroid.db"):
+    """Queues a role sync for a worker process.
+
+    A task already pending for the same user, guild and reason absorbs it.
+
+    Args:
+        user_id (str): The Discord ID of the user.
+        guild_id (str): The Discord ID of the guild.
+        reason (str): Why the sync was queued; selects what the worker does.
+        now (float): The current UNIX time.
+        db_name (str): The name of the database file.
+    """
+    _execute(
+        db_name,
+        """
+        INSERT OR IGNORE INTO sync_tasks
+            (user_id, guild_id, reason, available_at, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+        (user_id, guild_id, reason, now, now),
+    )
+
+
+@_timed
+def claim_sync_tasks(owner, limit, lease_seconds, now, db_name="democradroid.db"):
+    """Leases the oldest available sync tasks to a worker.
+
+    Tasks are available when pending and due, or when the lease of the
+    worker that claimed them has expired.
+
+    Args:
+        owner (str): A string identifying the worker.
+        limit (int): The maximum number of tasks to claim.
+        lease_seconds (float): Seconds the worker has to finish the tasks.
+        now (float): The current UNIX time.
+        db_name (str): The name of the database file.
+    Returns:
+        list: Tuples of task ID, Discord user ID, guild ID, reason and the
+        number of attempts including this one.
+    """
+    with _lock:
+        conn = get_connection(db_name)
+        # Take the write lock up front so two workers never claim one task.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tasks = conn.execute(
+                """
+                SELECT id, user_id, guild_id, reason, attempts + 1 FROM sync_tasks
+                WHERE (status = 'pending' AND available_at <= ?)
+                   OR (status = 'claimed' AND lease_expires < ?)
+                ORDER BY id LIMIT ?
+            """,
+                (now, now, limit),
+            ).fetchall()
+            conn.executemany(
+                """
+                UPDATE sync_tasks SET status = 'claimed', lease_owner = ?,
+                    lease_expires = ?, attempts = attempts + 1
+                WHERE id = ?
+            """,
+                [(owner, now + lease_seconds, task[0]) for task in tasks],
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return tasks
+
+
+@_timed
+def complete_sync_task(task_id, owner, db_name="democradroid.db"):
+    """Removes a finished sync task.
+
+    Args:
+        task_id (int): The task ID.
+        owner (str): The worker that claimed the task.
+        db_name (str): The name of the database file.
+    """
+    _execute(
+        db_name,
+        "DELETE FROM sync_tasks WHERE id = ? AND lease_owner = ?",
+        (task_id, owner),
+    )
+
+
+@_timed
+def fail_sync_task(task_id, owner, error, retry_at, db_name="democradroid.db"):
+    """Records a failed attempt at a sync task.
+
+    Args:
+        task_id (int): The task ID.
+        owner (str): The worker that claimed the task.
+        error (str): What went wrong.
+        retry_at (float): The UNIX time to retry at, or None to give up and
+            mark the task failed.
+        db_name (str): The name of the database file.
+    """
+    if retry_at is None:
+        _execute(
+            db_name,
+            """
+            UPDATE sync_tasks SET status = 'failed', error = ?, lease_owner = NULL
+            WHERE id = ? AND lease_owner = ?
+        """,
+            (error, task_id, owner),
+        )
+        return
+    with _lock:
+        conn = get_connection(db_name)
+        conn.execute(
+            """
+            UPDATE OR IGNORE sync_tasks SET status = 'pending', available_at = ?,
+                error = ?, lease_owner = NULL
+            WHERE id = ? AND lease_owner = ?
+        """,
+            (retry_at, error, task_id, owner),
+        )
+        # Still claimed means an identical task is already pending; drop this one.
+        conn.execute(
+            "DELETE FROM sync_tasks WHERE id = ? AND lease_owner = ?",
+            (task_id, owner),
+        )
+        conn.commit()
+
+
+@_timed
+def count_sync_tasks(db_name="democradroid.db"):
+    """Counts the sync tasks in each status.
+
+    Args:
+        db_name (str): The name of the database file.
+    Returns:
+        dict: Statuses mapped to their number of tasks.
+    """
+    return dict(
+        _fetchall(db_name, "SELECT status, COUNT(*) FROM sync_tasks GROUP BY status")
+    )
+
+
+@_timed
+def get_pending_verifications(now, limit, db_name="democradroid.db"):
+    """Retrieves unexpired pending verifications, least recently checked first.
+
+    Args:
+        now (float): The current UNIX time.
+        limit (int): The maximum number of verifications to return.
+        db_name (str): The name of the database file.
+    Returns:
+        list: Tuples of user ID, Discord ID, DemocracyOnline ID, code, and
+        the guild and channel IDs /verify was used in.
+    """
+    pending = _fetchall(
+        db_name,
+        """
+        SELECT id, discord_id, democracyonline_id, verification_code,
+               code_guild_id, code_channel_id
+        FROM users
+        WHERE verified = 0 AND verification_code IS NOT NULL
+          AND code_expires_at > ?
+        ORDER BY COALESCE(code_checked_at, 0)
+        LIMIT ?
+    """,
+        (now, limit),
+    )
+    return pending
+
+
+@_timed
+def mark_verifications_checked(user_ids, checked_at, db_name="democradroid.db"):
+    """Records when pending verifications were last checked.
+
+    Args:
+        user_ids (list): The unique IDs of the users.
+        checked_at (float): The UNIX time they were checked.
+        db_name (str): The name of the database file.
+    """
+    with _lock:
+        conn = get_connection(db_name)
+        conn.executemany(
+            "UPDATE users SET code_checked_at = ? WHERE id = ?",
+            [(checked_at, user_id) for user_id in user_ids],
+        )
+        conn.commit()
+
+
+@_timed
+def purge_expired_verifications(now, db_name="democradroid.db"):
+    """Deletes unverified links whose verification code has expired.
+
+    Args:
+        now (float): The current UNIX time.
+        db_name (str): The name of the database file.
+    Returns:
+        int: The number of links deleted.
+    """
+    with _lock:
+        conn = get_connection(db_name)
+        cursor = conn.execute(
+            """
+            DELETE FROM users
+            WHERE verified = 0 AND verification_code IS NOT NULL
+              AND code_expires_at <= ?
+        """,
+            (now,),
+        )
+        conn.commit()
+    return cursor.rowcount
+
+
+@_timed
+def get_cached_profile(kind, key, db_name="democradroid.db"):
+    """Retrieves a cached DemocracyOnline record.
+
+    Args:
+        kind (str): "user" or "party".
+        key (str): The DemocracyOnline ID.
+        db_name (str): The name of the database file.
+    Returns:
+        tuple: The data and the UNIX time it was fetched, or None.
+    """
+    row = _fetchone(
+        db_name,
+        "SELECT data, fetched_at FROM profile_cache WHERE kind = ? AND key = ?",
+        (kind, key),
+    )
+    return (json.loads(row[0]), row[1]) if row else None
+
+
+@_timed
+def set_cached_profile(kind, key, data, fetched_at, db_name="democradroid.db"):
+    """Stores a fetched DemocracyOnline record.
+
+    Args:
+        kind (str): "user" or "party".
+        key (str): The DemocracyOnline ID.
+        data (dict): The record.
+        fetched_at (float): The UNIX time it was fetched.
+        db_name (str): The name of the database file.
+    """
+    _execute(
+        db_name,
+        """
+        INSERT OR REPLACE INTO profile_cache (kind, key, data, fetched_at)
+        VALUES (?, ?, ?, ?)
+    """,
+        (kind, key, json.dumps(data), fetched_at),
+    )
+
+
+@_timed
+def get_meta(key, db_name="democradroid.db"):
+    """Retrieves a stored setting.
+
+    Args:
+        key (str): The name of the setting.
+        db_name (str): The name of the database file.
+    Returns:
+        str: The value, or None if it was never set.
+    """
+    row = _fetchone(db_name, "SELECT value FROM meta WHERE key = ?", (key,))
+    return row[0] if row else None
+
+
+@_timed
+def set_meta(key, value, db_name="democradroid.db"):
+    """Stores a setting.
+
+    Args:
+        key (str): The name of the setting.
+        value (str): The value.
+        db_name (str): The name of the database file.
+    """
+    _execute(
+        db_name,
+        "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+        (key, value),
+    )
+
+
+@_timed
+def prune_profile_cache(before, db_name="democradroid.db"):
+    """Deletes cached DemocracyOnline records fetched before a time.
+
+    Args:
+        before (float): The UNIX time before which records are deleted.
+        db_name (str): The name of the database file.
+    Returns:
+        int: The number of records deleted.
+    """
+    with _lock:
+        conn = get_connection(db_name)
+        cursor = conn.execute(
+            """
+            DELETE FROM profile_cache WHERE fetched_at < ?
+        """,
+            (before,),
+        )
+        conn.commit()
+    return cursor.rowcount
@@ -7,107 +7,225 @@ import discord
 from discord import app_commands
 import database as db
 import dofuncs as do
+import guildfuncs as gf
+import bulk
+import rolesync
+import scheduler
+import mutations
+import profiles
+import metrics
+import jobs
+import leases
+import verifier
 import random as r
-from datetime import datetime, time, timedelta
+from collections import defaultdict
 import asyncio
+import traceback
+import hashlib
+import json
+import time
+import argparse
 
 
 intents = discord.Intents.default()
 intents.members = True
-client = discord.Client(intents=intents)
+# Runs every shard unless main() is given an explicit range, see --shards
+client = discord.AutoShardedClient(intents=intents)
 tree = app_commands.CommandTree(client)
 
-updatelock = False
-
 adminids = [357228102226542602, 888758436739813407]
 
+# Default number of users processed at once by the bulk role commands.
+bulk_concurrency = 8
+# Hand background role syncs to worker processes (see worker.py) instead of
+# applying them in this process. Set with --sync-workers.
+sync_workers = False
+# Sync the command tree on startup even if it is unchanged, see --force-sync
+force_sync = False
+# Whether on_ready has already run the one-time initialization
+initialized = False
+
+# Serialise role creation so concurrent workers don't create duplicates.
+party_role_locks = defaultdict(asyncio.Lock)
+job_role_locks = defaultdict(asyncio.Lock)
+
+job_role_names = ("Representative", "Senator", "President")
+role_registry = gf.RoleRegistry(job_role_names)
+
+# Role edits, role creation and scheduled posts all go through this queue
+mutation_queue = mutations.MutationQueue()
+
+
+def owns_guild(guild_id):
+    """Returns whether a guild belongs to one of this process's shards.
+
+    Args:
+        guild_id (int): The Discord ID of the guild.
+    """
+    if client.shard_ids is None:
+        return True
+    return (int(guild_id) >> 22) % client.shard_count in client.shard_ids
+
+
+def shard_scope():
+    """Returns a name for the set of shards this process runs."""
+    if client.shard_ids is None:
+        return "all"
+    return f"{','.join(map(str, sorted(client.shard_ids)))}/{client.shard_count}"
 
-async def role_for_party(guild, party_id):
+
+async def role_for_party(
+    guild, party_id, ctx=None, place=True, priority=mutations.INTERACTIVE
+):
     # Add a party role if it doesn't exist, else return existing role_for_party
-    role_id = db.get_party_role(party_id, str(guild.id))
-    if role_id is not None:
-        role = guild.get_role(int(role_id))
+    # New roles are moved to the top of the hierarchy unless place is False,
+    # in which case the caller places them (see ensure_party_roles)
+    role = role_registry.party_role(guild, party_id)
+    if role is not None:
+        return role
+    async with party_role_locks[(guild.id, str(party_id))]:
+        role = role_registry.party_role(guild, party_id)
         if role is not None:
             return role
-        else:
-            # Role not found in guild, remove from db
-            db.remove_party_role(party_id, str(guild.id))
-    party_info = do.fetch_party(party_id)
-    if party_info is None:
-        return None
-    role_name = party_info["name"]  # type: ignore
-    party_color = int(party_info["color"].lstrip("#"), 16)  # type: ignore
-    role = await guild.create_role(name=role_name, color=discord.Color(party_color))
-    # Set role to top of hierarchy
-    position = len(guild.roles) - 1
-    while True:
-        try:
-            await role.edit(position=position)
-            break
-        except:
-            position -= 1
-            if position < 1:
-                break
-    db.add_party_role(party_id, str(role.id), str(guild.id))
-    return role
-
-
-async def assign_party_role(guild, discord_id, democracyonline_id):
-    do_user_info = do.fetch_user(democracyonline_id)
-    if do_user_info is None:
-        return
-    party_id = do_user_info.get("partyId")  # type: ignore
-    if party_id is None:
-        return
-    role = await role_for_party(guild, party_id)
-    if role is None:
-        return
-    member = await guild.fetch_member(discord_id)
-    if member is None:
-        return
+        # Another process (gateway or sync worker) may have created it since
+        # this process's registry was built.
+        role_id = db.get_party_role(str(party_id), str(guild.id))
+        role = await gf.find_role(guild, role_id) if role_id is not None else None
+        if role is not None:
+            role_registry.add_party_role(party_id, role)
+            return role
+        party_info = await (ctx or do.FetchContext()).party(party_id)
+        if party_info is None:
+            return None
+        role_name = party_info["name"]  # type: ignore
+        party_color = party_info["color_int"]  # type: ignore
+        role = await mutation_queue.create_role(
+            guild, priority, name=role_name, color=discord.Color(party_color)
+        )
+        db.add_party_role(party_id, str(role.id), str(guild.id))
+        role_registry.add_party_role(party_id, role)
+        if place:
+            await place_party_roles(guild, [role], priority)
+        return role
 
-    # Remove other party roles first, if they're a member
-    for dcrole in db.list_party_roles(str(guild.id)):
-        party_role = guild.get_role(int(dcrole[1]))
-        if party_role is not None:
-            await member.remove_roles(party_role)
-    await member.add_roles(role)
 
+async def place_party_roles(guild, roles, priority=mutations.INTERACTIVE):
+    # Set roles to top of hierarchy, as far as the bot is allowed to
+    try:
+        await gf.place_roles(guild, roles, mutation_queue, priority)
+    except discord.HTTPException as e:
+        print(f"Could not move party roles to the top of the hierarchy: {e}")
 
-async def assign_role_by_job(guild, discord_id, democracyonline_id):
-    do_user_info = do.fetch_user(democracyonline_id)
-    if do_user_info is None:
+
+async def ensure_party_roles(
+    guild, party_ids, ctx=None, priority=mutations.INTERACTIVE
+):
+    # Create every missing party role first, then place them all in one go
+    created = []
+    for party_id in dict.fromkeys(str(party_id) for party_id in party_ids):
+        if role_registry.party_role(guild, party_id) is not None:
+            continue
+        role = await role_for_party(guild, party_id, ctx, False, priority)
+        if role is not None:
+            created.append(role)
+    if created:
+        await place_party_roles(guild, created, priority)
+
+
+async def party_role_plan(
+    guild, do_user_info, ctx=None, priority=mutations.INTERACTIVE
+):
+    # Returns (desired, managed) party roles for a DemocracyOnline user.
+    managed = role_registry.party_roles(guild)
+    desired = []
+    party_id = do_user_info.get("partyId")
+    if party_id is not None:
+        role = await role_for_party(guild, party_id, ctx, priority=priority)
+        if role is not None:
+            desired.append(role)
+    return desired, managed
+
+
+async def job_role_plan(guild, do_user_info, priority=mutations.INTERACTIVE):
+    # Returns (desired, managed) job roles for a DemocracyOnline user.
+    # role here is "Representative", "Senator", "President" or something else
+    job_id = do_user_info.get("role")
+    async with job_role_locks[guild.id]:
+        roles = {name: role_registry.job_role(guild, name) for name in job_role_names}
+        if job_id in roles and roles[job_id] is None and gf.rest_only:
+            # Without gateway events, another process may have created them
+            await gf.refresh_roles(guild)
+            role_registry.forget(guild.id)
+            roles = {
+                name: role_registry.job_role(guild, name) for name in job_role_names
+            }
+        if job_id in roles and roles[job_id] is None:
+            # Create whichever job roles are missing
+            for name in job_role_names:
+                if roles[name] is None:
+                    roles[name] = await mutation_queue.create_role(
+                        guild, priority, name=name, color=discord.Color.blue()
+                    )
+                    role_registry.add_job_role(roles[name])
+    managed = [role for role in roles.values() if role is not None]
+    desired = [roles[job_id]] if job_id in roles else []
+    return desired, managed
+
+
+async def assign_party_role(
+    guild, discord_id, democracyonline_id, ctx=None, priority=mutations.INTERACTIVE
+):
+    ctx = ctx or do.FetchContext()
+    do_user_info = await ctx.user(democracyonline_id)
+    if not isinstance(do_user_info, dict):
         return
-    job_id = do_user_info.get("role")  # type: ignore
-    if job_id is None:
-        return
-    # role here is now "Representative", "Senator", "President"
-    # Check discord for a role with that name
-    role = discord.utils.get(guild.roles, name=job_id)
-    if role is None:
-        # Create the roles
-        await guild.create_role(name="Representative", color=discord.Color.blue())
-        await guild.create_role(name="Senator", color=discord.Color.blue())
-        await guild.create_role(name="President", color=discord.Color.blue())
-        role = discord.utils.get(guild.roles, name=job_id)
-        if role is None:
-            print(f"Could not create role for job {job_id}")
-            return
+    member = await gf.resolve_member(guild, discord_id)
+    if member is None:
+        return
+    desired, managed = await party_role_plan(guild, do_user_info, ctx, priority)
+    await gf.reconcile_roles(
+        member, desired, managed, queue=mutation_queue, priority=priority
+    )
 
-    reprole = discord.utils.get(guild.roles, name="Representative")
-    senatorrole = discord.utils.get(guild.roles, name="Senator")
-    presidentrole = discord.utils.get(guild.roles, name="President")
 
-    # Remove other job roles first
-    member = await guild.fetch_member(discord_id)
+async def assign_role_by_job(
+    guild, discord_id, democracyonline_id, ctx=None, priority=mutations.INTERACTIVE
+):
+    ctx = ctx or do.FetchContext()
+    do_user_info = await ctx.user(democracyonline_id)
+    if not isinstance(do_user_info, dict):
+        return
+    member = await gf.resolve_member(guild, discord_id)
     if member is None:
         return
+    desired, managed = await job_role_plan(guild, do_user_info, priority)
+    await gf.reconcile_roles(
+        member, desired, managed, queue=mutation_queue, priority=priority
+    )
 
-    await member.remove_roles(reprole)
-    await member.remove_roles(senatorrole)
-    await member.remove_roles(presidentrole)
 
-    await member.add_roles(role)
+async def assign_roles(
+    guild, discord_id, democracyonline_id, ctx=None, priority=mutations.INTERACTIVE
+):
+    # Party and job roles together, applied with at most one member edit
+    ctx = ctx or do.FetchContext()
+    do_user_info = await ctx.user(democracyonline_id)
+    if not isinstance(do_user_info, dict):
+        return
+    member = await gf.resolve_member(guild, discord_id)
+    if member is None:
+        return
+    party_desired, party_managed = await party_role_plan(
+        guild, do_user_info, ctx, priority
+    )
+    job_desired, job_managed = await job_role_plan(guild, do_user_info, priority)
+    await gf.reconcile_roles(
+        member,
+        party_desired + job_desired,
+        party_managed + job_managed,
+        queue=mutation_queue,
+        priority=priority,
+    )
 
 
 @tree.command(
@@ -123,7 +241,8 @@ async def verify(interaction, user_id: int):
     discord_user_name = str(interaction.user)
 
     # Get the DemocracyOnline user info from the user ID
-    do_user_info = do.fetch_user(user_id)
+    ctx = do.FetchContext(budget=do.interactive_budget)
+    do_user_info = await ctx.user(user_id)
     if do_user_info is None:
         await interaction.response.send_message(
             "Could not find a DemocracyOnline user with that ID. Please check and try again."
@@ -146,7 +265,8 @@ async def verify(interaction, user_id: int):
         )
         return
 
-    if record[4] is not None:
+    # record[6] is when the code expires; expired codes are replaced below
+    if record[4] is not None and (record[6] is None or record[6] > time.time()):
         print("Checking for verification code in bio...")
         print(f"Verification code: {record[4]}")
         print(f"User bio: {do_user_info['bio']}")  # type: ignore
@@ -157,23 +277,31 @@ async def verify(interaction, user_id: int):
                 f"Your DemocracyOnline account (ID: {user_id}) has been successfully verified and linked to your Discord account ({discord_user_name})."
             )
 
-            # Set party roles
+            # Set party roles, no longer in a hurry now the reply is sent
+            ctx.budget = None
             guild = interaction.guild
             if guild is not None:
-                await assign_party_role(
-                    guild, discord_user_id, record[2]
-                )  # record[2] is democracyonline_id
-                await assign_role_by_job(
-                    guild, discord_user_id, record[2]
+                await assign_roles(
+                    guild, discord_user_id, record[2], ctx
                 )  # record[2] is democracyonline_id
             return
 
     # Generate a verification code
     vcode = r.randint(1000000000, 9999999999)
-    db.add_verification_code(record[0], str(vcode))
+    now = time.time()
+    db.add_verification_code(
+        record[0],
+        str(vcode),
+        created_at=now,
+        expires_at=now + verifier.code_ttl,
+        guild_id=str(interaction.guild.id) if interaction.guild is not None else None,
+        channel_id=(
+            str(interaction.channel_id) if interaction.channel_id is not None else None
+        ),
+    )
 
     await interaction.response.send_message(
-        f"To verify your DemocracyOnline account (ID: {user_id}), please add the following verification code to your DemocracyOnline bio: `{vcode}`. After updating your bio, please run the /verify command again."
+        f"To verify your DemocracyOnline account (ID: {user_id}), please add the following verification code to your DemocracyOnline bio within {verifier.code_ttl // 60} minutes: `{vcode}`. I will check your bio regularly and let you know once you are verified, or you can run the /verify command again after updating it."
     )
 
 
@@ -198,19 +326,19 @@ async def whoami(interaction):
         )
         return
     else:
-        do_user_info = do.fetch_user(user[2])
+        ctx = do.FetchContext(budget=do.interactive_budget)
+        do_user_info, age = await profiles.get_user(user[2], ctx)
         if do_user_info is None:
             await interaction.response.send_message(
                 "Could not retrieve your DemocracyOnline account information. Please try again later."
             )
             return
 
+        party = None
         if do_user_info.get("partyId") is not None:  # type: ignore
-            party_color = int(
-                do.fetch_party(do_user_info["partyId"])["color"].lstrip("#"), 16  # type: ignore
-            )
-        else:
-            party_color = 0x000000
+            party, party_age = await profiles.get_party(do_user_info["partyId"], ctx)  # type: ignore
+            age = max(age, party_age or 0)
+        party_color = party["color_int"] if party is not None else 0x000000  # type: ignore
 
         embed = discord.Embed(
             title="DemocracyOnline Account Information",
@@ -219,7 +347,7 @@ async def whoami(interaction):
             ),
         )
 
-        party_title = do.fetch_party(do_user_info["partyId"])["name"] if do_user_info.get("partyId") is not None else "None"  # type: ignore
+        party_title = party["name"] if party is not None else "None"  # type: ignore
 
         embed.add_field(name="Username", value=do_user_info["username"], inline=False)  # type: ignore
         embed.add_field(name="Bio", value=do_user_info["bio"], inline=False)  # type: ignore
@@ -233,17 +361,16 @@ async def whoami(interaction):
             value=do_user_info.get("createdAt", "Not currently available"),  # type: ignore
             inline=False,
         )
+        embed.set_footer(text=f"Profile data fetched {profiles.describe_age(age)}")
 
         await interaction.response.send_message(embed=embed)
 
-        # Add party role to user like wit verify
+        # Add party role to user like wit verify, no longer in a hurry now
+        ctx.budget = None
         guild = interaction.guild
         if guild is not None:
-            await assign_party_role(
-                guild, discord_user_id, user[2]
-            )  # user[2] is democracyonline_id
-            await assign_role_by_job(
-                guild, discord_user_id, user[2]
+            await assign_roles(
+                guild, discord_user_id, user[2], ctx
             )  # user[2] is democracyonline_id
 
 
@@ -292,19 +419,19 @@ async def whois(interaction, user: discord.Member):
         )
         return
     else:
-        do_user_info = do.fetch_user(record[2])
+        ctx = do.FetchContext(budget=do.interactive_budget)
+        do_user_info, age = await profiles.get_user(record[2], ctx)
         if do_user_info is None:
             await interaction.response.send_message(
                 "Could not retrieve the specified user's DemocracyOnline account information."
             )
             return
 
+        party = None
         if do_user_info.get("partyId") is not None:  # type: ignore
-            party_color = int(
-                do.fetch_party(do_user_info["partyId"])["color"].lstrip("#"), 16  # type: ignore
-            )
-        else:
-            party_color = 0x000000
+            party, party_age = await profiles.get_party(do_user_info["partyId"], ctx)  # type: ignore
+            age = max(age, party_age or 0)
+        party_color = party["color_int"] if party is not None else 0x000000  # type: ignore
 
         embed = discord.Embed(
             title="DemocracyOnline Account Information",
@@ -313,7 +440,7 @@ async def whois(interaction, user: discord.Member):
             ),
         )
 
-        party_title = do.fetch_party(do_user_info["partyId"])["name"] if do_user_info.get("partyId") is not None else "None"  # type: ignore
+        party_title = party["name"] if party is not None else "None"  # type: ignore
 
         embed.add_field(name="Username", value=do_user_info["username"], inline=False)  # type: ignore
         embed.add_field(name="Bio", value=do_user_info["bio"], inline=False)  # type: ignore
@@ -327,21 +454,20 @@ async def whois(interaction, user: discord.Member):
             value=do_user_info.get("createdAt", "Not currently available"),  # type: ignore
             inline=False,
         )
+        embed.set_footer(text=f"Profile data fetched {profiles.describe_age(age)}")
 
         await interaction.response.send_message(embed=embed)
 
-        # Add party role to user like wit verify
+        # Add party role to user like wit verify, no longer in a hurry now
+        ctx.budget = None
         guild = interaction.guild
         if guild is not None:
             print(
                 f"Assigning roles for user {user.name} with Discord ID {discord_user_id} and DemocracyOnline ID {record[2]}"
             )  # record[2] is democracyonline_id
-            await assign_party_role(
-                guild, discord_user_id, record[2]
-            )  # user[2] is democracyonline_id
-            await assign_role_by_job(
-                guild, discord_user_id, record[2]
-            )  # user[2] is democracyonline_id
+            await assign_roles(
+                guild, discord_user_id, record[2], ctx
+            )  # record[2] is democracyonline_id
 
 
 @tree.command(
@@ -417,236 +543,748 @@ async def forceverify(interaction, discord_id: str, democracyonline_id: str):
     # Set party roles
     guild = interaction.guild
     if guild is not None:
-        await assign_party_role(guild, discord_id, democracyonline_id)
-        await assign_role_by_job(guild, discord_id, democracyonline_id)
+        await assign_roles(guild, discord_id, democracyonline_id)
 
 
 @tree.command(
-    name="processpartyroles",
-    description="Assign party roles to all verified users based on their DemocracyOnline party affiliation",
+    name="invalidateparty",
+    description="Drop cached DemocracyOnline party data (Admin only)",
 )
-async def processpartyroles(interaction):
-    guild = interaction.guild
-    if guild is None:
+async def invalidateparty(interaction, party_id: str = ""):
+    if interaction.user.id not in adminids:
         await interaction.response.send_message(
-            "This command can only be used in a server."
+            "You do not have permission to use this command."
         )
         return
 
-    verified_users = db.get_all_verified_users()
-    for user in verified_users:
+    dropped = do.invalidate_party(party_id if party_id != "" else None)
+    stats = do.party_cache.stats()
+    await interaction.response.send_message(
+        f"Dropped {dropped} cached part{'y' if dropped == 1 else 'ies'}. "
+        f"Cache now holds {stats['size']} (hits: {stats['hits']}, misses: {stats['misses']})."
+    )
+
+
+async def sync_member_roles(
+    guild, discord_id, democracyonline_id, ctx=None, reason="role_sync"
+):
+    """Brings a member's party and job roles up to date as background work.
+
+    With ``sync_workers`` set the update is queued for a worker process
+    instead of being applied here.
+
+    Args:
+        guild (discord.Guild): The guild to update the member in.
+        discord_id (str): The Discord ID of the member.
+        democracyonline_id (str): The DemocracyOnline ID of the member.
+        ctx (dofuncs.FetchContext): Shared fetches, if any.
+        reason (str): What the worker should update, see worker.py.
+    """
+    if sync_workers:
+        db.enqueue_sync_task(str(discord_id), str(guild.id), reason, time.time())
+        return
+    await assign_roles(
+        guild, discord_id, democracyonline_id, ctx, mutations.BACKGROUND
+    )
+
+
+def queue_sync_job(guild, reason):
+    # Job handler for worker mode: queue one sync task per member, fetch nothing
+    async def process(user, ctx):
+        if guild.chunked and guild.get_member(int(user[1])) is None:
+            raise bulk.Skip(f"Could not find member with Discord ID {user[1]}")
+        await sync_member_roles(guild, user[1], user[2], reason=reason)
+
+    return process, None
+
+
+async def prefetch_profiles(verified_users, ctx):
+    # Fetch a page of DemocracyOnline profiles in batches before the workers run
+    await ctx.prefetch_users([user[2] for user in verified_users])
+
+
+def party_roles_job(guild, params):
+    """Job handler assigning party roles to verified users, see jobs.JobRunner."""
+    if sync_workers:
+        return queue_sync_job(guild, "party_roles")
+
+    async def process(user, ctx):
         discord_user_id = user[1]
         democracyonline_id = user[2]
-        do_user_info = do.fetch_user(democracyonline_id)
-        if do_user_info is None:
-            print(
+        do_user_info = await ctx.user(democracyonline_id)
+        if not isinstance(do_user_info, dict):
+            raise bulk.Skip(
                 f"Could not fetch user info for DemocracyOnline ID {democracyonline_id}"
             )
-            continue
-        party_id = do_user_info.get("partyId")  # type: ignore
+        party_id = do_user_info.get("partyId")
         if party_id is None:
-            print(f"User {democracyonline_id} is not affiliated with any party.")
-            continue
-        role = await role_for_party(guild, party_id)
-        if role is None:
-            print(f"Could not create or fetch role for party ID {party_id}")
-            continue
-        try:
-            member = await guild.fetch_member(discord_user_id)
-        except discord.errors.NotFound:
-            member = None
+            raise bulk.Skip(
+                f"User {democracyonline_id} is not affiliated with any party."
+            )
+        member = await gf.resolve_member(guild, discord_user_id)
         if member is None:
-            print(f"Could not find member with Discord ID {discord_user_id}")
-            continue
-        await member.add_roles(role)
+            raise bulk.Skip(f"Could not find member with Discord ID {discord_user_id}")
+        desired, managed = await party_role_plan(
+            guild, do_user_info, ctx, mutations.BACKGROUND
+        )
+        if not desired:
+            raise bulk.Skip(f"Could not create or fetch role for party ID {party_id}")
+        await gf.reconcile_roles(
+            member,
+            desired,
+            managed,
+            queue=mutation_queue,
+            priority=mutations.BACKGROUND,
+        )
+
+    async def prepare(verified_users, ctx):
+        # Create all missing party roles up front so they are placed together
+        await prefetch_profiles(verified_users, ctx)
+        party_ids = []
+        for user in verified_users:
+            do_user_info = ctx.users.get(str(user[2]))
+            if isinstance(do_user_info, dict) and do_user_info.get("partyId"):
+                party_ids.append(do_user_info["partyId"])
+        await ensure_party_roles(guild, party_ids, ctx, mutations.BACKGROUND)
+
+    return process, prepare
+
+
+def job_roles_job(guild, params):
+    """Job handler assigning job roles to verified users, see jobs.JobRunner."""
+    if sync_workers:
+        return queue_sync_job(guild, "job_roles")
+
+    async def process(user, ctx):
+        discord_user_id = user[1]
+        democracyonline_id = user[2]
+        if await gf.resolve_member(guild, discord_user_id) is None:
+            raise bulk.Skip(f"Could not find member with Discord ID {discord_user_id}")
+        await assign_role_by_job(
+            guild, discord_user_id, democracyonline_id, ctx, mutations.BACKGROUND
+        )
+
+    return process, prefetch_profiles
+
+
+job_runner = jobs.JobRunner(
+    client,
+    {"party_roles": party_roles_job, "job_roles": job_roles_job},
+    mutation_queue,
+    owns=owns_guild,
+)
+
+
+async def submit_job(interaction, kind, title, concurrency):
+    # Queue a bulk job for the interaction's guild and reply with its ID
+    if interaction.guild is None:
+        await interaction.response.send_message(
+            "This command can only be used in a server."
+        )
+        return
+    job_id = job_runner.submit(
+        kind,
+        interaction.guild.id,
+        interaction.channel_id,
+        {"concurrency": concurrency},
+    )
     await interaction.response.send_message(
-        "Processed party roles for all verified users."
+        f"{title} queued as job #{job_id}. Use `/jobs status {job_id}` to follow it; "
+        "a summary will be posted here when it finishes."
     )
 
 
+@tree.command(
+    name="processpartyroles",
+    description="Assign party roles to all verified users based on their DemocracyOnline party affiliation",
+)
+async def processpartyroles(
+    interaction, concurrency: app_commands.Range[int, 1, 50] = bulk_concurrency
+):
+    await submit_job(interaction, "party_roles", "Processing party roles", concurrency)
+
+
 @tree.command(
     name="processjobroles",
     description="Assign job roles to all verified users based on their DemocracyOnline job",
 )
-async def processjobroles(interaction):
-    guild = interaction.guild
-    if guild is None:
+async def processjobroles(
+    interaction, concurrency: app_commands.Range[int, 1, 50] = bulk_concurrency
+):
+    await submit_job(interaction, "job_roles", "Processing job roles", concurrency)
+
+
+jobs_group = app_commands.Group(name="jobs", description="Manage background jobs")
+tree.add_command(jobs_group)
+
+
+@jobs_group.command(name="list", description="List recent background jobs")
+async def jobs_list(interaction):
+    recent = db.list_jobs(limit=10)
+    if not recent:
+        await interaction.response.send_message("No jobs yet.")
+        return
+    await interaction.response.send_message(
+        "\n".join(jobs.describe(job) for job in recent)
+    )
+
+
+@jobs_group.command(name="status", description="Show the progress of a job")
+async def jobs_status(interaction, job_id: int):
+    job = db.get_job(job_id)
+    if job is None:
+        await interaction.response.send_message(f"There is no job #{job_id}.")
+        return
+    lines = [jobs.describe(job)]
+    for label, error in job["errors"][:10]:
+        lines.append(f"- {label}: {error}")
+    await interaction.response.send_message("\n".join(lines))
+
+
+@jobs_group.command(name="cancel", description="Cancel a queued or running job")
+async def jobs_cancel(interaction, job_id: int):
+    if interaction.user.id not in adminids:
         await interaction.response.send_message(
-            "This command can only be used in a server."
+            "You do not have permission to use this command."
         )
         return
 
-    verified_users = db.get_all_verified_users()
-    for user in verified_users:
-        discord_user_id = user[1]
-        democracyonline_id = user[2]
-        try:
-            await assign_role_by_job(guild, discord_user_id, democracyonline_id)
-        except discord.errors.NotFound:
-            print(f"Could not find member with Discord ID {discord_user_id}")
-            continue
-    await interaction.response.send_message(
-        "Processed job roles for all verified users."
-    )
+    if job_runner.cancel(job_id):
+        await interaction.response.send_message(f"Cancelling job #{job_id}.")
+    else:
+        await interaction.response.send_message(
+            f"Job #{job_id} does not exist or has already ended."
+        )
 
 
 @tree.command(
     name="gameupdate",
-    description="Fetch the latest game data from DemocracyOnline and update the database",
+    description="Post the latest DemocracyOnline game state here, and again every day",
 )
 async def gameupdate(
-    interaction, roletoping: discord.Role = None, pingonfirstrun: bool = False  # type: ignore
+    interaction,
+    roletoping: discord.Role = None,  # type: ignore
+    pingonfirstrun: bool = False,
+    posttime: str = scheduler.default_post_time,
+    showchanges: bool = True,
 ):
-    global updatelock
-
     if interaction.user.id not in adminids:
         await interaction.response.send_message(
             "You do not have permission to use this command."
         )
         return
 
-    # This function sends a current game state update to a channel, and then continues
-    # to do so every day at 8pm utc
+    # This function sends a current game state update to a channel, and then
+    # subscribes the channel to an update every day at posttime (UTC)
 
     channel = interaction.channel
-    if channel is None:
+    if channel is None or interaction.guild is None:
         await interaction.response.send_message(
             "This command can only be used in a server channel."
         )
         return
 
+    post_time = scheduler.parse_post_time(posttime)
+    if post_time is None:
+        await interaction.response.send_message(
+            "Please give the time as HH:MM in UTC, for example 20:05."
+        )
+        return
+
+    # Save the subscription and acknowledge before the slow game state fetch
+    db.add_game_update(
+        str(channel.id),
+        str(interaction.guild.id),
+        str(roletoping.id) if roletoping is not None else None,
+        post_time,
+        showchanges,
+    )
+    game_updates.reschedule()
+    await interaction.response.defer()
+
     # Game data logic here
-    data = do.fetch_game_state_data()
+    data = await do.fetch_game_state_data_async()
+    if "error" in data:
+        await interaction.followup.send(
+            f"{data['error']} This channel will still get a game update every "
+            f"day at {post_time} UTC."
+        )
+        return
+
+    # The first post doubles as the baseline for the change-only daily
+    # posts, which skip a slot whose game state has not changed.
+    if pingonfirstrun and roletoping is not None:
+        await channel.send(f"{roletoping.mention} Here is the latest game update.")
+    await interaction.followup.send(embed=scheduler.game_state_embed(data))
+    await channel.send(
+        f"This channel will get a game update every day at {post_time} UTC."
+    )
+
+
+@tree.command(
+    name="stopgameupdate",
+    description="Stop the daily DemocracyOnline game state update in this channel",
+)
+async def stopgameupdate(interaction):
+    if interaction.user.id not in adminids:
+        await interaction.response.send_message(
+            "You do not have permission to use this command."
+        )
+        return
+
+    db.remove_game_update(str(interaction.channel_id))
+    game_updates.reschedule()
+    await interaction.response.send_message(
+        "This channel will no longer get daily game updates."
+    )
+
+
+role_sync = rolesync.RoleSyncDaemon(client, sync_member_roles)
+game_updates = scheduler.GameUpdateScheduler(client, mutation_queue)
+
+
+async def complete_verification(pending, ctx):
+    """Assigns roles to and notifies a user verified by the poller.
 
-    # Consists of a dict with:
-    # - Current election statuses senate and presidential
-    # - Current House Bills
-    # - Current Senate Bills
-    # - Current Presidential Bills
+    Args:
+        pending (tuple): A row from ``database.get_pending_verifications``.
+        ctx (dofuncs.FetchContext): The poll's shared fetches.
+    """
+    user_id, discord_id, democracyonline_id, code, guild_id, channel_id = pending
+    guild = client.get_guild(int(guild_id)) if guild_id is not None else None
+    if guild is not None:
+        await sync_member_roles(guild, discord_id, democracyonline_id, ctx)
+    # Guilds on other shards get their roles from their own role sync, which
+    # checks users that were never synced first.
 
-    embed = discord.Embed(
-        title="Current DemocracyOnline Game State", color=discord.Color.purple()
+    text = (
+        f"Your DemocracyOnline account (ID: {democracyonline_id}) has been "
+        "successfully verified and linked to your Discord account."
     )
-    # Add election statuses
+    try:
+        user = await client.fetch_user(int(discord_id))
+        dm = await user.create_dm()
+        await mutation_queue.send(dm, mutations.BACKGROUND, content=text)
+        return
+    except discord.HTTPException as e:
+        print(f"Could not DM Discord ID {discord_id}: {e}")
+    if channel_id is None:
+        return
+    # DMs are closed; mention them where they ran /verify instead
+    try:
+        channel = client.get_channel(int(channel_id))
+        if channel is None:
+            channel = await client.fetch_channel(int(channel_id))
+        await mutation_queue.send(
+            channel, mutations.BACKGROUND, content=f"<@{discord_id}> {text}"
+        )
+    except discord.HTTPException as e:
+        print(f"Could not notify Discord ID {discord_id}: {e}")
+
+
+verification_poller = verifier.VerificationPoller(complete_verification)
+
+# Lease keepers of the singleton background tasks, built on first ready
+background_leases = []
+
+
+def start_background_tasks():
+    """Starts competing for the leases of the singleton background tasks.
+
+    Game updates and the verification poller run in one process overall.
+    Role sync and the job runner only touch guilds of this process's shards,
+    so they run once per shard scope.
+    """
+    if not background_leases:
+        scope = shard_scope()
+        role_sync.scope = scope
+        tasks = {
+            "game_updates": game_updates,
+            "verifier": verification_poller,
+            f"role_sync:{scope}": role_sync,
+            f"jobs:{scope}": job_runner,
+        }
+        background_leases.extend(
+            leases.LeaseKeeper(name, task.start, task.stop)
+            for name, task in tasks.items()
+        )
+    for lease in background_leases:
+        lease.start()
+
+
+cache_lookups = metrics.Gauge(
+    "democradroid_cache_lookups", "Cache lookups by result.", ("cache", "result")
+)
+client_events = metrics.Gauge(
+    "democradroid_api_client_events",
+    "DemocracyOnline client counters (coalesced, retries, stale, ...).",
+    ("event",),
+)
+breaker_open = metrics.Gauge(
+    "democradroid_api_breaker_open",
+    "Whether an endpoint's circuit breaker is open.",
+    ("endpoint",),
+)
+queue_depth = metrics.Gauge(
+    "democradroid_mutation_queue_depth", "Discord mutations waiting to be sent."
+)
+queue_events = metrics.Gauge(
+    "democradroid_mutation_queue_events",
+    "Mutation queue counters (queued, merged, failed, rate_limited).",
+    ("event",),
+)
+role_sync_events = metrics.Gauge(
+    "democradroid_role_sync_events", "Role sync daemon counters.", ("event",)
+)
+verification_events = metrics.Gauge(
+    "democradroid_verification_events", "Verification poller counters.", ("event",)
+)
+sync_tasks = metrics.Gauge(
+    "democradroid_sync_tasks", "Role sync tasks queued for workers.", ("status",)
+)
+
+
+def collect_metrics():
+    """Copies the counters kept by other modules into gauges."""
+    party = do.party_cache.stats()
+    cache_lookups.set(party["hits"], cache="party", result="hit")
+    cache_lookups.set(party["misses"], cache="party", result="miss")
+    cache_lookups.set(gf.member_stats["cache_hits"], cache="member", result="hit")
+    cache_lookups.set(gf.member_stats["chunk_hits"], cache="member", result="chunk")
+    cache_lookups.set(gf.member_stats["rest_fallbacks"], cache="member", result="miss")
+    for event, count in do.coalesce_stats().items():
+        client_events.set(count, event=event)
+    for endpoint, state in do.breaker_states().items():
+        breaker_open.set(int(state == "open"), endpoint=endpoint)
+    summary = mutation_queue.summary()
+    queue_depth.set(summary["depth"])
+    for event in ("queued", "merged", "failed", "rate_limited"):
+        queue_events.set(summary[event], event=event)
+    for event, count in role_sync.stats.items():
+        role_sync_events.set(count, event=event)
+    for event, count in verification_poller.stats.items():
+        verification_events.set(count, event=event)
+    for status, count in db.count_sync_tasks().items():
+        sync_tasks.set(count, status=status)
+
+
+metrics.register_collector(collect_metrics)
+
+
+def _ms(seconds):
+    if seconds is None:
+        return "-"
+    if seconds == float("inf"):
+        return "slow"
+    return f"{seconds * 1000:.0f}ms"
+
+
+def _hit_rate(hits, misses):
+    total = hits + misses
+    return f"{hits / total:.0%}" if total else "-"
+
+
+def stats_embed():
+    """Renders the bot's runtime metrics as an embed.
+
+    Returns:
+        discord.Embed: The embed.
+    """
+    embed = discord.Embed(title="Democradroid Stats", color=discord.Color.purple())
+
+    commands = sorted(
+        metrics.command_seconds.summary().items(), key=lambda item: -item[1]["count"]
+    )
+    embed.add_field(
+        name="Commands (count, p50/p95)",
+        value="\n".join(
+            f"/{name}{'' if outcome == 'ok' else f' [{outcome}]'}: {s['count']}, "
+            f"{_ms(s['p50'])}/{_ms(s['p95'])}"
+            for (name, outcome), s in commands[:10]
+        )
+        or "None yet",
+        inline=False,
+    )
+
+    breakers = do.breaker_states()
     embed.add_field(
-        name="Senate Election Status",
-        value=data["senate_election"],
+        name="DemocracyOnline API (count, p50/p95/p99)",
+        value="\n".join(
+            f"{endpoint}: {s['count']}, {_ms(s['p50'])}/{_ms(s['p95'])}/"
+            f"{_ms(s['p99'])}"
+            + (" [breaker open]" if breakers.get(endpoint) == "open" else "")
+            for endpoint, s in do.latency_stats().items()
+        )
+        or "None yet",
         inline=False,
     )
+
+    queries = sorted(
+        metrics.db_seconds.summary().items(),
+        key=lambda item: -item[1]["mean"] * item[1]["count"],
+    )
     embed.add_field(
-        name="Presidential Election Status",
-        value=data["president_election"],
+        name="Database, by total time (count, mean)",
+        value="\n".join(
+            f"{name}: {s['count']}, {s['mean'] * 1000:.2f}ms"
+            for (name,), s in queries[:8]
+        )
+        or "None yet",
         inline=False,
     )
+
+    party = do.party_cache.stats()
+    coalesce = do.coalesce_stats()
     embed.add_field(
-        name="Current House Bills",
+        name="Caches",
         value=(
-            "\n".join(data["current_house_bills"])
-            if data["current_house_bills"]
-            else "None"
+            f"Party cache: {_hit_rate(party['hits'], party['misses'])} hits "
+            f"({party['size']} entries)\n"
+            f"API requests coalesced: {coalesce['coalesced']}/{coalesce['requests']}, "
+            f"served stale: {coalesce['served_stale']}\n"
+            f"{gf.member_stats_summary()}"
         ),
         inline=False,
     )
+
+    queue = mutation_queue.summary()
     embed.add_field(
-        name="Current Senate Bills",
+        name="Mutation Queue",
         value=(
-            "\n".join(data["current_senate_bills"])
-            if data["current_senate_bills"]
-            else "None"
+            f"Depth: {queue['depth']}, rate limited: {queue['rate_limited']}, "
+            f"failed: {queue['failed']}\n"
+            f"Average wait: {_ms(queue['wait_avg'][mutations.INTERACTIVE])} "
+            f"interactive, {_ms(queue['wait_avg'][mutations.BACKGROUND])} background"
         ),
         inline=False,
     )
+
     embed.add_field(
-        name="Current Presidential Bills",
+        name="Event Loop Lag (p50/p95)",
         value=(
-            "\n".join(data["current_presidential_bills"])
-            if data["current_presidential_bills"]
-            else "None"
+            f"{_ms(metrics.loop_lag_seconds.quantile(0.5))}/"
+            f"{_ms(metrics.loop_lag_seconds.quantile(0.95))}"
         ),
         inline=False,
     )
-    if pingonfirstrun and roletoping is not None:
-        await channel.send(f"{roletoping.mention} Here is the latest game update.")
-    await interaction.response.send_message(embed=embed)
+    return embed
+
 
-    if updatelock:
-        await channel.send("Game update loop is already running.")
+@tree.command(
+    name="stats",
+    description="Show command, API, database and cache metrics (Admin only)",
+)
+async def stats(interaction):
+    if interaction.user.id not in adminids:
+        await interaction.response.send_message(
+            "You do not have permission to use this command."
+        )
         return
-    updatelock = True
 
-    while True:
-        # Wait until 8pm UTC
+    await interaction.response.send_message(embed=stats_embed())
 
-        now = datetime.now(tz=None)
-        target_time = datetime.combine(now.date(), time(20, 5))
-        if now > target_time:
-            target_time += timedelta(days=1)
-        wait_seconds = (target_time - now).total_seconds()
-        await asyncio.sleep(wait_seconds)
 
-        # Game data logic here
-        data = do.fetch_game_state_data()
+def _command_name(interaction, command=None):
+    command = command or interaction.command
+    return command.qualified_name if command is not None else "unknown"
 
-        # Consists of a dict with:
-        # - Current election statuses senate and presidential
-        # - Current House Bills
-        # - Current Senate Bills
-        # - Current Presidential Bills
 
-        embed = discord.Embed(
-            title="Current DemocracyOnline Game State", color=discord.Color.purple()
-        )
-        # Add election statuses
-        embed.add_field(
-            name="Senate Election Status",
-            value=data["senate_election"],
-            inline=False,
-        )
-        embed.add_field(
-            name="Presidential Election Status",
-            value=data["president_election"],
-            inline=False,
-        )
-        embed.add_field(
-            name="Current House Bills",
-            value=(
-                "\n".join(data["current_house_bills"])
-                if data["current_house_bills"]
-                else "None"
-            ),
-            inline=False,
-        )
-        embed.add_field(
-            name="Current Senate Bills",
-            value=(
-                "\n".join(data["current_senate_bills"])
-                if data["current_senate_bills"]
-                else "None"
-            ),
-            inline=False,
-        )
-        embed.add_field(
-            name="Current Presidential Bills",
-            value=(
-                "\n".join(data["current_presidential_bills"])
-                if data["current_presidential_bills"]
-                else "None"
-            ),
-            inline=False,
-        )
-        if roletoping is not None:
-            await channel.send(f"{roletoping.mention} Here is the latest game update.")
-        await channel.send(embed=embed)
+def _command_latency(interaction):
+    return (discord.utils.utcnow() - interaction.created_at).total_seconds()
+
+
+@client.event
+async def on_app_command_completion(interaction, command):
+    metrics.command_seconds.observe(
+        _command_latency(interaction),
+        command=_command_name(interaction, command),
+        outcome="ok",
+    )
+
+
+@tree.error
+async def on_app_command_error(interaction, error):
+    metrics.command_seconds.observe(
+        _command_latency(interaction),
+        command=_command_name(interaction),
+        outcome="error",
+    )
+    print(f"Command {_command_name(interaction)} failed:")
+    traceback.print_exception(error)
+
+
+@client.event
+async def on_guild_role_create(role):
+    role_registry.role_created(role)
+
+
+@client.event
+async def on_guild_role_update(before, after):
+    role_registry.role_updated(before, after)
+
+
+@client.event
+async def on_guild_role_delete(role):
+    party_id = role_registry.role_deleted(role)
+    if party_id is not None:
+        # Party role deleted in Discord, remove from db
+        db.remove_party_role(party_id, str(role.guild.id))
+
+
+@client.event
+async def on_guild_remove(guild):
+    role_registry.forget(guild.id)
 
 
 @client.event
 async def on_ready():
+    # on_ready fires again after reconnects; initialize only once
+    global initialized
+    if initialized:
+        print("Reconnected")
+        return
+    initialized = True
+
     # Check if db exists, if not create
     db.init_db()
-    await tree.sync()
+    try:
+        await sync_command_tree()
+    except discord.HTTPException as e:
+        print(f"Could not sync the command tree: {e}")
+    start_background_tasks()
+    try:
+        await metrics.start()
+    except OSError as e:
+        print(f"Could not start the metrics endpoint: {e}")
     print("Ready!")
 
 
-with open(".token", "r") as f:
-    token = f.read().strip()
-client.run(token)
+def command_tree_hash():
+    """Returns a hash of the global command definitions sent to Discord."""
+    payload = sorted(
+        (command.to_dict(tree) for command in tree.get_commands()),
+        key=lambda command: (command.get("type", 1), command["name"]),
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+async def sync_command_tree(force=False):
+    """Syncs the command tree unless it is unchanged since the last sync.
+
+    The hash of the last synced definition is stored per application, so
+    restarts and reconnects skip the slow, heavily rate-limited global sync.
+
+    Args:
+        force (bool): Whether to sync even if the definition is unchanged.
+    Returns:
+        bool: Whether the tree was synced.
+    """
+    key = f"command_tree_hash:{client.application_id}"
+    digest = command_tree_hash()
+    if not (force or force_sync) and db.get_meta(key) == digest:
+        print("Command tree unchanged, skipping sync")
+        return False
+    await tree.sync()
+    db.set_meta(key, digest)
+    print("Command tree synced")
+    return True
+
+
+async def shutdown():
+    """Stops the background tasks and closes the API session and database."""
+    for lease in background_leases:
+        lease.stop()
+    await metrics.stop()
+    await do.close()
+    db.close_connections()
+
+
+async def run_bot(token):
+    """Runs the bot until it is closed, then shuts everything down.
+
+    Args:
+        token (str): The Discord bot token.
+    """
+    async with client:
+        try:
+            await client.start(token)
+        finally:
+            await shutdown()
+
+
+def parse_shard_ids(value):
+    """Parses a shard range such as "0-3" or a list such as "0,2,5".
+
+    Args:
+        value (str): The shard IDs.
+    Returns:
+        list: The shard IDs.
+    """
+    shard_ids = []
+    for part in value.split(","):
+        first, _, last = part.strip().partition("-")
+        try:
+            shard_ids.extend(range(int(first), int(last or first) + 1))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid shard IDs: {value!r}")
+    return sorted(set(shard_ids))
+
+
+def main(argv=None):
+    """Runs the bot.
+
+    Args:
+        argv (list): Command line arguments, defaults to ``sys.argv[1:]``.
+    """
+    parser = argparse.ArgumentParser(description="Run the Democradroid bot.")
+    parser.add_argument(
+        "--shard-count",
+        type=int,
+        help="Total number of shards across all processes (default: Discord's "
+        "recommendation)",
+    )
+    parser.add_argument(
+        "--shards",
+        type=parse_shard_ids,
+        help='Shard IDs run by this process, e.g. "0-3" or "0,2" (default: all)',
+    )
+    parser.add_argument(
+        "--sync-workers",
+        action="store_true",
+        help="Queue background role syncs for worker processes (see worker.py)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=metrics.metrics_port,
+        help="Port of the local Prometheus endpoint",
+    )
+    parser.add_argument(
+        "--force-sync",
+        action="store_true",
+        help="Sync the command tree even if it is unchanged",
+    )
+    global sync_workers, force_sync
+    args = parser.parse_args(argv)
+    if args.shards is not None:
+        if args.shard_count is None:
+            parser.error("--shards requires --shard-count")
+        if args.shards[-1] >= args.shard_count:
+            parser.error("shard IDs must be below --shard-count")
+    client.shard_count = args.shard_count
+    client.shard_ids = args.shards
+    metrics.metrics_port = args.metrics_port
+    sync_workers = args.sync_workers
+    force_sync = args.force_sync
+
+    with open(".token", "r") as f:
+        token = f.read().strip()
+    discord.utils.setup_logging()
+    try:
+        asyncio.run(run_bot(token))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
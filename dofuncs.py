@@ -3,46 +3,658 @@
 This module contains helper functions for the Democradroid bot.
 """
 
+import asyncio
+import random
+import time
+from collections import OrderedDict, deque
+from urllib.parse import parse_qs, urlsplit
+
+import aiohttp
 import requests
 
+import metrics
+
 base_url = "https://democracyonline.io/api/"
 
+# Seconds before a single democracyonline.io request is abandoned.
+request_timeout = 10
+# Per-endpoint overrides of request_timeout.
+endpoint_timeouts = {"users": 5, "parties": 5, "game-state": 15}
+# Seconds an interactive command waits for a request before giving up, so it
+# can answer within Discord's 3s window. The request itself keeps going.
+interactive_budget = 2.0
+# Extra attempts made for a failed GET, and the base backoff between them.
+max_retries = 2
+retry_backoff = 0.5
+# Consecutive failed requests that open an endpoint's circuit breaker, and
+# the seconds it stays open before a trial request is let through.
+breaker_threshold = 5
+breaker_cooldown = 30
+# Seconds a successful response may be served in place of a failed request,
+# and the number of such responses kept.
+stale_ttl = 6 * 3600
+stale_cache_size = 4096
+# Number of recent latencies kept per endpoint for percentiles.
+latency_window = 1000
+# Maximum number of democracyonline.io requests in flight at once.
+max_concurrency = 10
+# Maximum number of pooled keep-alive connections to democracyonline.io.
+pool_size = 20
+# Maximum number of IDs sent in one multi-ID users request.
+users_batch_size = 50
+# Seconds a cached party record is served before it is fetched again.
+party_cache_ttl = 3600
+# Maximum number of party records kept in the cache.
+party_cache_size = 256
 
-def fetch_user(user_id):
+_client = None
+
+
+class CircuitBreaker:
+    """Stops calling an unhealthy endpoint for a while.
+
+    The breaker opens after ``threshold`` consecutive failures. Once
+    ``cooldown`` seconds have passed one trial request is let through; its
+    outcome closes the breaker again or keeps it open for another cooldown.
+
+    Args:
+        threshold (int): Consecutive failures that open the breaker.
+        cooldown (float): Seconds the breaker stays open.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        return "closed" if self.opened_at is None else "open"
+
+    def allow(self):
+        """Returns whether a request may be sent now."""
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            # Let one trial request through per cooldown.
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class DOClient:
+    """Async client for the democracyonline.io API.
+
+    A client owns one aiohttp session, so every request made through it shares
+    the same keep-alive connection pool. Concurrency is capped by a semaphore
+    and every request is bounded by a per-endpoint timeout. Failed GETs are
+    retried with jittered backoff, and each endpoint has a circuit breaker;
+    while an endpoint fails, the last good response for a path is served
+    if there is one.
+
+    Args:
+        base (str): The API base url. Defaults to ``base_url``.
+        timeout (float): Seconds before a request is abandoned.
+        concurrency (int): Maximum number of requests in flight at once.
+        pool (int): Maximum number of pooled connections.
+    """
+
+    def __init__(self, base=None, timeout=None, concurrency=None, pool=None):
+        self.base_url = (base or base_url).rstrip("/") + "/"
+        self.timeout = aiohttp.ClientTimeout(total=timeout or request_timeout)
+        self.pool_size = pool or pool_size
+        self._semaphore = asyncio.Semaphore(concurrency or max_concurrency)
+        self._session = None
+        self._inflight = {}
+        # Whether the server answers multi-ID users requests; None until tried.
+        self.batch_users = None
+        self.stats = {
+            "requests": 0,
+            "upstream": 0,
+            "coalesced": 0,
+            "retries": 0,
+            "failures": 0,
+            "short_circuited": 0,
+            "served_stale": 0,
+            "over_budget": 0,
+        }
+        self.breakers = {}
+        self.latencies = {}
+        self._last_good = TTLCache(stale_cache_size, stale_ttl)
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout
+            )
+        return self._session
+
+    async def get(self, path, budget=None):
+        """Performs a GET request against the API.
+
+        Identical requests already in flight are coalesced: callers share one
+        upstream call and receive the same decoded body, which must therefore
+        be treated as read-only.
+
+        Args:
+            path (str): The path relative to the base url.
+            budget (float): If given, the seconds this caller waits, retries
+                included. Past it the last good response is returned if there
+                is one, and the request carries on for later callers.
+        Returns:
+            tuple: The status code and the decoded JSON body, or the response
+            text if the request was not successful.
+        """
+        self.stats["requests"] += 1
+        task = self._inflight.get(path)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["upstream"] += 1
+            task = asyncio.ensure_future(self._get(path))
+            self._inflight[path] = task
+            task.add_done_callback(lambda done: self._finish(path, done))
+        # Shielded so one caller giving up does not cancel the others.
+        if budget is None:
+            return await asyncio.shield(task)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), budget)
+        except asyncio.TimeoutError:
+            self.stats["over_budget"] += 1
+            return self._fallback(path, 0, f"No answer within {budget}s")
+
+    def _finish(self, path, task):
+        if self._inflight.get(path) is task:
+            del self._inflight[path]
+        if not task.cancelled():
+            # Mark the exception retrieved even if every caller was cancelled.
+            task.exception()
+
+    def _breaker(self, endpoint):
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        return self.breakers[endpoint]
+
+    def _record_latency(self, endpoint, seconds):
+        if endpoint not in self.latencies:
+            self.latencies[endpoint] = deque(maxlen=latency_window)
+        self.latencies[endpoint].append(seconds)
+
+    def _fallback(self, path, status, body):
+        stale = self._last_good.get(path)
+        if stale is not None:
+            self.stats["served_stale"] += 1
+            return 200, stale
+        return status, body
+
+    async def _get(self, path):
+        endpoint = _endpoint_name(path)
+        breaker = self._breaker(endpoint)
+        if not breaker.allow():
+            self.stats["short_circuited"] += 1
+            return self._fallback(path, 503, f"Circuit open for {endpoint}")
+
+        for attempt in range(max_retries + 1):
+            if attempt:
+                self.stats["retries"] += 1
+                delay = retry_backoff * 2 ** (attempt - 1)
+                await asyncio.sleep(delay * (0.5 + random.random()))
+            started = time.monotonic()
+            try:
+                status, body = await self._request(path, endpoint)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                # ValueError: a 200 whose body is not JSON, e.g. a maintenance
+                # page. It counts as a failed attempt like a network error.
+                status, body = 0, repr(e)
+            elapsed = time.monotonic() - started
+            self._record_latency(endpoint, elapsed)
+            metrics.api_seconds.observe(elapsed, endpoint=endpoint)
+            metrics.api_requests.inc(endpoint=endpoint, status=status or "error")
+            # 4xx answers other than 429 come from a healthy upstream.
+            if 0 < status < 500 and status != 429:
+                breaker.success()
+                if status == 200:
+                    self._last_good.set(path, body)
+                return status, body
+
+        self.stats["failures"] += 1
+        breaker.failure()
+        return self._fallback(path, status, body)
+
+    async def _request(self, path, endpoint):
+        session = self._get_session()
+        timeout = aiohttp.ClientTimeout(
+            total=endpoint_timeouts.get(endpoint, self.timeout.total)
+        )
+        async with self._semaphore:
+            async with session.get(self.base_url + path, timeout=timeout) as response:
+                if response.status != 200:
+                    return response.status, await response.text()
+                return response.status, await response.json(content_type=None)
+
+    def latency_stats(self):
+        """Returns request latency percentiles per endpoint.
+
+        Returns:
+            dict: Each endpoint mapped to its sample ``count`` and ``p50``,
+            ``p95`` and ``p99`` latencies in seconds.
+        """
+        stats = {}
+        for endpoint, samples in self.latencies.items():
+            ordered = sorted(samples)
+            stats[endpoint] = {"count": len(ordered)}
+            for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+                index = min(len(ordered) - 1, int(q * len(ordered)))
+                stats[endpoint][name] = ordered[index] if ordered else 0.0
+        return stats
+
+    async def close(self):
+        """Closes the underlying session and its connection pool."""
+        # Requests a budgeted caller left running would reopen the session.
+        for task in list(self._inflight.values()):
+            task.cancel()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after a fixed time to live.
+
+    Args:
+        maxsize (int): The maximum number of entries kept.
+        ttl (float): Seconds an entry stays valid after it is stored.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        """Returns the cached value for a key, or None if missing or expired."""
+        entry = self._data.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        """Stores a value, evicting the least recently used entry if full."""
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Drops one entry, or every entry if no key is given.
+
+        Returns:
+            int: The number of entries dropped.
+        """
+        if key is None:
+            count = len(self._data)
+            self._data.clear()
+            return count
+        return 1 if self._data.pop(key, None) is not None else 0
+
+    def stats(self):
+        """Returns the size and hit/miss counters of the cache."""
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+party_cache = TTLCache(party_cache_size, party_cache_ttl)
+
+
+def _endpoint_name(path):
+    # "bot?endpoint=users&id=1" -> "users"; other paths are named by path.
+    parts = urlsplit(path)
+    return parse_qs(parts.query).get("endpoint", [parts.path])[0]
+
+
+def get_client():
+    """Returns the shared client, creating it on first use.
+
+    Returns:
+        DOClient: The shared client.
+    """
+    global _client
+    if _client is None:
+        _client = DOClient()
+    return _client
+
+
+def latency_stats():
+    """Returns request latency percentiles per endpoint of the shared client.
+
+    Returns:
+        dict: See ``DOClient.latency_stats``.
+    """
+    return get_client().latency_stats()
+
+
+def breaker_states():
+    """Returns the circuit breaker state per endpoint of the shared client.
+
+    Returns:
+        dict: Each endpoint mapped to "open" or "closed".
+    """
+    return {name: breaker.state for name, breaker in get_client().breakers.items()}
+
+
+def coalesce_stats():
+    """Returns request coalescing counters of the shared client.
+
+    Returns:
+        dict: Total ``requests``, ``upstream`` calls made and requests
+        ``coalesced`` onto a call already in flight.
+    """
+    return dict(get_client().stats)
+
+
+async def close():
+    """Closes the shared client, if one was created."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+def _run_sync(func, *args):
+    # Runs an async fetch to completion with a throwaway client, for scripts
+    # that have no event loop of their own.
+    async def runner():
+        client = DOClient()
+        try:
+            return await func(*args, client=client)
+        finally:
+            await client.close()
+
+    return asyncio.run(runner())
+
+
+class FetchError:
+    """Stands in for a user that ``fetch_users_async`` could not fetch.
+
+    Args:
+        status (int): The HTTP status, or 0 if the request itself failed.
+        detail (str): The error text of the response.
+    """
+
+    def __init__(self, status, detail):
+        self.status = status
+        self.detail = detail
+
+    def __repr__(self):
+        return f"FetchError({self.status}, {self.detail!r})"
+
+
+def _batch_unsupported(status):
+    # 4xx answers mean the server rejects multi-ID requests; timeouts, 429s,
+    # 5xx and open breakers are transient and say nothing about support.
+    return 400 <= status < 500 and status not in (408, 429)
+
+
+async def fetch_user_async(user_id, client=None, budget=None):
     """Fetches the description of a user from democracyonline.io.
 
     Args:
         user_id (str): The ID of the user.
+        client (DOClient): The client to use. Defaults to the shared client.
+        budget (float): Seconds to wait at most, see ``DOClient.get``.
     Returns:
-        requests.json: The data of the user.
+        dict: The data of the user, or None if it could not be fetched.
     """
-
-    url = f"{base_url}bot?endpoint=users&id={user_id}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
+    client = client or get_client()
+    status, data = await client.get(f"bot?endpoint=users&id={user_id}", budget)
+    if status == 200:
         return data
     else:
-        print(f"Error: {response.status_code} - {response.text}")
-        return "Error fetching user description."
+        print(f"Error: {status} - {data}")
+        return None
 
 
-def fetch_party(party_id):
+async def fetch_users_async(user_ids, client=None):
+    """Fetches the descriptions of many users from democracyonline.io.
+
+    IDs are requested in chunks of ``users_batch_size`` with a multi-ID
+    ``bot?endpoint=users&ids=...`` request. If the server does not answer
+    those, or leaves IDs out, the remaining users are fetched one by one,
+    concurrently and bounded by the client's concurrency limit. Batching is
+    only given up for good when the server rejects it, not after a
+    transient failure.
+
+    Args:
+        user_ids (list): The IDs of the users.
+        client (DOClient): The client to use. Defaults to the shared client.
+    Returns:
+        dict: Each ID mapped to the data of the user, or to a ``FetchError``
+        if that user could not be fetched.
+    """
+    client = client or get_client()
+    ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+    results = {}
+
+    if client.batch_users is not False:
+        for start in range(0, len(ids), users_batch_size):
+            chunk = ids[start : start + users_batch_size]
+            status, data = await client.get(f"bot?endpoint=users&ids={','.join(chunk)}")
+            users = _parse_user_batch(data, chunk) if status == 200 else None
+            if users is None:
+                if status == 200 or _batch_unsupported(status):
+                    client.batch_users = False
+                    break
+                # Leave this chunk to the single fetches below.
+                continue
+            client.batch_users = True
+            results.update(users)
+
+    remaining = [user_id for user_id in ids if user_id not in results]
+    responses = await asyncio.gather(
+        *(client.get(f"bot?endpoint=users&id={user_id}") for user_id in remaining)
+    )
+    for user_id, (status, data) in zip(remaining, responses):
+        results[user_id] = data if status == 200 else FetchError(status, data)
+    return results
+
+
+def _parse_user_batch(data, ids):
+    # Accepts a list of users or a dict keyed by ID, keeping requested IDs
+    # only. Anything else means the server does not support batching.
+    if isinstance(data, list):
+        users = {str(user.get("id")): user for user in data if isinstance(user, dict)}
+    elif isinstance(data, dict) and any(user_id in data for user_id in ids):
+        users = {str(key): user for key, user in data.items()}
+    else:
+        return None
+    return {user_id: users[user_id] for user_id in ids if user_id in users}
+
+
+async def fetch_party_async(party_id, client=None, budget=None):
     """Fetches the info of a party from democracyonline.io.
+
     Args:
         party_id (str): The ID of the party.
+        client (DOClient): The client to use. Defaults to the shared client.
+        budget (float): Seconds to wait at most, see ``DOClient.get``.
     Returns:
-        requests.json: The data of the party.
+        dict: The data of the party, or None if it could not be fetched.
     """
-
-    url = f"{base_url}/bot?endpoint=parties&id={party_id}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
+    client = client or get_client()
+    status, data = await client.get(f"bot?endpoint=parties&id={party_id}", budget)
+    if status == 200:
         return data
     else:
-        print(f"Error: {response.status_code} - {response.text}")
-        return "Error fetching party info."
+        print(f"Error: {status} - {data}")
+        return None
+
+
+async def get_party(party_id, client=None, refresh=False, budget=None):
+    """Returns the info of a party, served from ``party_cache`` when fresh.
+
+    The party color is parsed once and stored as an int under ``color_int``.
+
+    Args:
+        party_id (str): The ID of the party.
+        client (DOClient): The client to use. Defaults to the shared client.
+        refresh (bool): Whether to fetch the party even if it is cached.
+        budget (float): Seconds to wait at most, see ``DOClient.get``.
+    Returns:
+        dict: The data of the party, or None if it could not be fetched.
+    """
+    key = str(party_id)
+    party = None if refresh else party_cache.get(key)
+    if party is not None:
+        return party
+    party = await fetch_party_async(party_id, client=client, budget=budget)
+    if not isinstance(party, dict):
+        return None
+    party["color_int"] = _parse_color(party.get("color"))
+    party_cache.set(key, party)
+    return party
+
+
+class FetchContext:
+    """Request-scoped memo of DemocracyOnline lookups.
+
+    Commands create one context per interaction and pass it to the helpers
+    they call, so every user and party is fetched at most once per
+    interaction however many helpers need it.
+
+    Args:
+        client (DOClient): The client to use. Defaults to the shared client.
+        budget (float): Seconds each lookup waits at most, for commands that
+            must answer quickly; see ``DOClient.get``. Callers may clear it
+            once they have responded.
+    """
+
+    def __init__(self, client=None, budget=None):
+        self.client = client
+        self.budget = budget
+        self.users = {}
+        self.parties = {}
+        # Users a batch prefetch could not fetch, as FetchError by ID.
+        self.errors = {}
+
+    async def user(self, user_id):
+        """Returns the data of a user, fetching it on first use."""
+        key = str(user_id)
+        if key not in self.users:
+            self.users[key] = await fetch_user_async(
+                user_id, client=self.client, budget=self.budget
+            )
+        return self.users[key]
+
+    async def prefetch_users(self, user_ids):
+        """Fetches every user not seen yet with one batched request."""
+        missing = [str(user_id) for user_id in user_ids if str(user_id) not in self.users]
+        if missing:
+            fetched = await fetch_users_async(missing, client=self.client)
+            for key, data in fetched.items():
+                if isinstance(data, FetchError):
+                    self.errors[key] = data
+                    data = None
+                self.users[key] = data
+
+    async def party(self, party_id):
+        """Returns the data of a party, fetching it on first use."""
+        key = str(party_id)
+        if key not in self.parties:
+            self.parties[key] = await get_party(
+                party_id, client=self.client, budget=self.budget
+            )
+        return self.parties[key]
+
+
+def invalidate_party(party_id=None):
+    """Drops a party, or every party if no ID is given, from ``party_cache``.
+
+    Args:
+        party_id (str): The ID of the party.
+    Returns:
+        int: The number of cached parties dropped.
+    """
+    return party_cache.invalidate(None if party_id is None else str(party_id))
+
+
+def _parse_color(color):
+    # "#rrggbb" -> int, falling back to black for missing or malformed colors.
+    try:
+        return int(str(color).lstrip("#"), 16)
+    except ValueError:
+        return 0x000000
+
+
+async def fetch_game_state_data_async(client=None) -> dict:
+    """Fetches the game state data from democracyonline.io.
+
+    Args:
+        client (DOClient): The client to use. Defaults to the shared client.
+    Returns:
+        dict: The game state data.
+    """
+    client = client or get_client()
+    status, data = await client.get("bot?endpoint=game-state")
+    if status != 200:
+        print(f"Error: {status} - {data}")
+        return {"error": "Error fetching game state data."}
+    return _parse_game_state(data)
+
+
+def fetch_user(user_id):
+    """Fetches the description of a user from democracyonline.io.
+
+    Blocking wrapper around ``fetch_user_async``.
+
+    Args:
+        user_id (str): The ID of the user.
+    Returns:
+        dict: The data of the user.
+    """
+    return _run_sync(fetch_user_async, user_id)
+
+
+def fetch_users(user_ids):
+    """Fetches the descriptions of many users from democracyonline.io.
+
+    Blocking wrapper around ``fetch_users_async``.
+
+    Args:
+        user_ids (list): The IDs of the users.
+    Returns:
+        dict: Each ID mapped to the data of the user, or to a ``FetchError``.
+    """
+    return _run_sync(fetch_users_async, user_ids)
+
+
+def fetch_party(party_id):
+    """Fetches the info of a party from democracyonline.io.
+
+    Blocking wrapper around ``fetch_party_async``.
+
+    Args:
+        party_id (str): The ID of the party.
+    Returns:
+        dict: The data of the party.
+    """
+    return _run_sync(fetch_party_async, party_id)
 
 
 def fetch_game_state_data_old() -> dict:
@@ -135,23 +747,26 @@ def fetch_game_state_data_old() -> dict:
 
 def fetch_game_state_data() -> dict:
     """Fetches the game state data from democracyonline.io.
+
+    Blocking wrapper around ``fetch_game_state_data_async``.
+
     Returns:
-        requests.json: The game state data.
+        dict: The game state data.
     """
+    return _run_sync(fetch_game_state_data_async)
 
-    url = f"{base_url}/bot?endpoint=game-state"
-    response = requests.get(url)
-    if response.status_code != 200:
-        print(f"Error: {response.status_code} - {response.text}")
-        return {"error": "Error fetching game state data."}
 
-    data = response.json()
+def _parse_game_state(data) -> dict:
+    # Flattens the raw game-state payload into the fields the bot posts.
     presdata = data[0]
     senatedata = data[1]
 
     returndata = {
         "president_election": presdata.get("status", "Unknown"),
         "senate_election": senatedata.get("status", "Unknown"),
+        # The raw statuses, without the daily countdown, for change detection.
+        "president_status": presdata.get("status", "Unknown"),
+        "senate_status": senatedata.get("status", "Unknown"),
         "current_presidential_bills": presdata.get(
             "bills_voting", ["Bill data coming soon."]
         ),
@@ -0,0 +1,291 @@
+"""guildfuncs.py
+
+This module contains Discord guild helper functions for the Democradroid bot.
+"""
+
+import asyncio
+from collections import defaultdict
+
+import discord
+
+import database as db
+import mutations
+
+# Set by processes without a gateway connection (see worker.py): guilds
+# cannot be chunked there, so members are always fetched over REST.
+rest_only = False
+
+# How member lookups were answered, see resolve_member.
+member_stats = {"cache_hits": 0, "chunk_hits": 0, "rest_fallbacks": 0, "not_found": 0}
+
+_chunk_locks = defaultdict(asyncio.Lock)
+
+
+async def resolve_member(guild, discord_id):
+    """Finds a guild member, preferring the gateway member cache over REST.
+
+    The member cache is checked first. If the guild has not been chunked yet
+    it is chunked once and checked again. A chunked guild caches every
+    member, so a miss there means the user is not in the guild. Only when
+    the cache cannot tell, e.g. in ``rest_only`` mode, is the member fetched
+    over REST.
+
+    Args:
+        guild (discord.Guild): The guild to search.
+        discord_id (str): The Discord ID of the member.
+    Returns:
+        discord.Member: The member, or None if they are not in the guild.
+    """
+    discord_id = int(discord_id)
+    member = guild.get_member(discord_id)
+    if member is not None:
+        member_stats["cache_hits"] += 1
+        return member
+
+    if not guild.chunked and not rest_only:
+        async with _chunk_locks[guild.id]:
+            if not guild.chunked:
+                await guild.chunk(cache=True)
+        member = guild.get_member(discord_id)
+        if member is not None:
+            member_stats["chunk_hits"] += 1
+            return member
+
+    if guild.chunked and not rest_only:
+        member_stats["not_found"] += 1
+        return None
+
+    member_stats["rest_fallbacks"] += 1
+    try:
+        return await guild.fetch_member(discord_id)
+    except discord.NotFound:
+        member_stats["not_found"] += 1
+        return None
+
+
+async def reconcile_roles(
+    member, desired, managed, reason=None, queue=None, priority=mutations.BACKGROUND
+):
+    """Brings a member's managed roles in line with a desired set.
+
+    Roles outside ``managed`` are left alone. The member is edited with a
+    single ``member.edit(roles=...)`` call, and only if something differs.
+
+    Args:
+        member (discord.Member): The member to update.
+        desired (list): The managed roles the member should have.
+        managed (list): Every role the bot controls for this purpose.
+        reason (str): The audit log reason for the edit.
+        queue (mutations.MutationQueue): If given, the edit is queued there
+            and may be merged with other pending edits of the member.
+        priority (int): The queue priority of the edit.
+    Returns:
+        bool: True if the member was edited.
+    """
+    desired = list({role.id: role for role in desired}.values())
+    desired_ids = {role.id for role in desired}
+    if queue is not None and queue.has_pending_edit(member):
+        # member.roles is about to change; merge the full intent instead.
+        remove = [role for role in managed if role.id not in desired_ids]
+        return await queue.edit_roles(member, desired, remove, reason, priority)
+    current_ids = {role.id for role in member.roles}
+    add = [role for role in desired if role.id not in current_ids]
+    remove = [
+        role
+        for role in managed
+        if role.id in current_ids and role.id not in desired_ids
+    ]
+    if not add and not remove:
+        return False
+    if queue is not None:
+        return await queue.edit_roles(member, add, remove, reason, priority)
+    remove_ids = {role.id for role in remove}
+    roles = [
+        role
+        for role in member.roles
+        if not role.is_default() and role.id not in remove_ids
+    ]
+    await member.edit(roles=roles + add, reason=reason)
+    return True
+
+
+async def place_roles(guild, roles, queue=None, priority=mutations.BACKGROUND):
+    """Moves roles directly below the bot's top role with one API call.
+
+    The new hierarchy is worked out locally from ``guild.roles`` and only
+    roles whose position changes are sent, in a single
+    ``guild.edit_role_positions`` call.
+
+    Args:
+        guild (discord.Guild): The guild the roles belong to.
+        roles (list): The roles to place, highest first.
+        queue (mutations.MutationQueue): If given, the call is sent through
+            it instead of directly.
+        priority (int): The queue priority.
+    Returns:
+        bool: True if any position was changed.
+    """
+    moving = {role.id for role in roles}
+    if not moving:
+        return False
+    top = guild.me.top_role
+    ordered = [
+        role
+        for role in sorted(guild.roles)
+        if role.id not in moving and not role.is_default()
+    ]
+    index = ordered.index(top) if top in ordered else len(ordered)
+    ordered[index:index] = reversed(list({role.id: role for role in roles}.values()))
+    positions = {
+        role: position
+        for position, role in enumerate(ordered, start=1)
+        if role.position != position
+    }
+    if not positions:
+        return False
+    if queue is None:
+        await guild.edit_role_positions(positions=positions)
+    else:
+        await queue.edit_role_positions(guild, positions, priority)
+    return True
+
+
+async def refresh_roles(guild):
+    """Re-reads a guild's roles over REST into its role cache.
+
+    Processes without gateway events (see ``rest_only``) use it to see
+    roles other processes created since the guild was fetched.
+
+    Args:
+        guild (discord.Guild): The guild.
+    """
+    for role in await guild.fetch_roles():
+        guild._add_role(role)
+
+
+async def find_role(guild, role_id):
+    """Returns a guild's role by ID, or None.
+
+    In ``rest_only`` mode a role missing from the cache may just be newer
+    than it, so the roles are re-read over REST before giving up.
+
+    Args:
+        guild (discord.Guild): The guild.
+        role_id (str): The Discord ID of the role.
+    """
+    role = guild.get_role(int(role_id))
+    if role is None and rest_only:
+        await refresh_roles(guild)
+        role = guild.get_role(int(role_id))
+    return role
+
+
+class RoleRegistry:
+    """Per-guild map of job names and party IDs to roles.
+
+    A guild's entries are built from ``guild.roles`` and the ``parties``
+    table on first use, then kept current by feeding it the gateway's role
+    create, update and delete events. Lookups are dictionary hits.
+
+    Args:
+        job_names (tuple): The names of the job roles to track.
+    """
+
+    def __init__(self, job_names):
+        self.job_names = tuple(job_names)
+        self._jobs = {}
+        self._parties = {}
+
+    def _guild(self, guild):
+        if guild.id not in self._jobs:
+            jobs = {}
+            for role in sorted(guild.roles):
+                if role.name in self.job_names:
+                    jobs.setdefault(role.name, role)
+            parties = {}
+            for party_id, role_id in db.list_party_roles(str(guild.id)):
+                role = guild.get_role(int(role_id))
+                if role is not None:
+                    parties[str(party_id)] = role
+            self._jobs[guild.id] = jobs
+            self._parties[guild.id] = parties
+        return self._jobs[guild.id], self._parties[guild.id]
+
+    def job_role(self, guild, name):
+        """Returns the role for a job name, or None."""
+        return self._guild(guild)[0].get(name)
+
+    def party_role(self, guild, party_id):
+        """Returns the role for a party ID, or None."""
+        return self._guild(guild)[1].get(str(party_id))
+
+    def party_roles(self, guild):
+        """Returns every known party role of a guild."""
+        return list(self._guild(guild)[1].values())
+
+    def add_job_role(self, role):
+        """Records a job role, keeping an existing one of the same name."""
+        if role.name in self.job_names:
+            self._guild(role.guild)[0].setdefault(role.name, role)
+
+    def add_party_role(self, party_id, role):
+        """Records the role of a party."""
+        self._guild(role.guild)[1][str(party_id)] = role
+
+    def forget(self, guild_id):
+        """Drops a guild so it is rebuilt on next use."""
+        self._jobs.pop(guild_id, None)
+        self._parties.pop(guild_id, None)
+
+    def role_created(self, role):
+        """Handles ``on_guild_role_create``."""
+        if role.guild.id in self._jobs:
+            self.add_job_role(role)
+
+    def _drop_job_role(self, guild, role):
+        jobs = self._guild(guild)[0]
+        for name, job_role in list(jobs.items()):
+            if job_role.id == role.id:
+                del jobs[name]
+                # Fall back to another role of the same name, if any.
+                for other in sorted(guild.roles):
+                    if other.name == name and other.id != role.id:
+                        jobs[name] = other
+                        break
+
+    def role_updated(self, before, after):
+        """Handles ``on_guild_role_update``."""
+        if after.guild.id not in self._jobs:
+            return
+        self._drop_job_role(after.guild, after)
+        self.add_job_role(after)
+        parties = self._guild(after.guild)[1]
+        for party_id, role in parties.items():
+            if role.id == after.id:
+                parties[party_id] = after
+
+    def role_deleted(self, role):
+        """Handles ``on_guild_role_delete``.
+
+        Returns:
+            str: The party ID the role belonged to, or None.
+        """
+        if role.guild.id not in self._jobs:
+            return None
+        self._drop_job_role(role.guild, role)
+        parties = self._guild(role.guild)[1]
+        for party_id, party_role in list(parties.items()):
+            if party_role.id == role.id:
+                del parties[party_id]
+                return party_id
+        return None
+
+
+def member_stats_summary():
+    """Returns a one-line report of how member lookups were answered."""
+    return (
+        f"Member lookups: {member_stats['cache_hits']} cached, "
+        f"{member_stats['chunk_hits']} after chunking, "
+        f"{member_stats['rest_fallbacks']} via REST "
+        f"({member_stats['not_found']} not found)."
+    )
@@ -0,0 +1,245 @@
+"""jobs.py
+
+This module runs long admin operations as persisted background jobs for the
+Democradroid bot.
+"""
+
+import asyncio
+import time
+
+import discord
+
+import bulk
+import database as db
+import dofuncs as do
+import mutations
+
+# Number of users processed between two checkpoints.
+job_page_size = 100
+# Default number of users processed at once within a page.
+job_concurrency = 8
+# Number of per-user failures kept on a job for /jobs status.
+job_max_errors = 20
+# Seconds between re-reads of the jobs table, which other processes may add
+# to or cancel in without being able to wake this runner.
+job_recheck = 30
+
+ACTIVE = ("queued", "running")
+
+
+def describe(job):
+    """Returns a one-line report of a job's status and progress.
+
+    Args:
+        job (dict): A job from ``database.get_job``.
+    """
+    done = job["succeeded"] + job["skipped"] + job["failed"]
+    line = (
+        f"#{job['id']} {job['kind']}: {job['status']}, processed "
+        f"{done}/{max(job['total'], done)} ({job['succeeded']} ok, "
+        f"{job['skipped']} skipped, {job['failed']} failed)"
+    )
+    if job["error"]:
+        line += f" - {job['error']}"
+    return line
+
+
+class JobRunner:
+    """Runs queued jobs one at a time, checkpointing to the ``jobs`` table.
+
+    A job walks every verified user in user ID order, a page at a time. After
+    each page its cursor and counters are saved, so a job interrupted by a
+    restart resumes after the last finished page. Once a job ends a summary
+    is posted to the channel it was started from.
+
+    Args:
+        client (discord.Client): The bot client, used to find guilds and
+            channels.
+        handlers (dict): Job kinds mapped to functions called as
+            ``handler(guild, params)``. A handler returns a ``(worker,
+            prepare)`` pair: ``worker(user, ctx)`` processes one verified
+            user and the optional ``prepare(users, ctx)`` runs once per page
+            before the workers, for instance to prefetch profiles into the
+            page's ``FetchContext``. Both are coroutine functions.
+        queue (mutations.MutationQueue): If given, summaries are sent
+            through it as background work.
+        page_size (int): The number of users per checkpoint.
+        owns (callable): If given, called with a guild ID; only jobs of
+            guilds it returns True for are run by this runner.
+    """
+
+    def __init__(self, client, handlers, queue=None, page_size=None, owns=None):
+        self.client = client
+        self.handlers = handlers
+        self.queue = queue
+        self.page_size = page_size or job_page_size
+        self.owns = owns
+        self._task = None
+        self._wake = asyncio.Event()
+        self._running = None
+
+    def start(self):
+        """Starts the runner unless it is already running.
+
+        Jobs left running by a previous process are resumed first.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """Stops the runner. An interrupted job resumes on the next start."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._running is not None:
+            self._running[1].cancel()
+
+    def submit(self, kind, guild_id, channel_id, params=None):
+        """Queues a job.
+
+        Args:
+            kind (str): The job kind, a key of ``handlers``.
+            guild_id (int): The Discord ID of the guild to work on.
+            channel_id (int): The Discord ID of the channel to report to.
+            params (dict): JSON-serialisable parameters for the handler.
+        Returns:
+            int: The job ID.
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind {kind!r}")
+        job_id = db.add_job(
+            kind,
+            str(guild_id),
+            str(channel_id) if channel_id is not None else None,
+            params or {},
+            time.time(),
+        )
+        self._wake.set()
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancels a queued or running job.
+
+        Returns:
+            bool: False if the job does not exist or has already ended.
+        """
+        job = db.get_job(job_id)
+        if job is None or job["status"] not in ACTIVE:
+            return False
+        if self._running is not None and self._running[0] == job_id:
+            # The run loop records the cancellation once the task stops.
+            self._running[1].cancel()
+            return True
+        # A job running in another process stops at its next page.
+        return db.set_job_status(job_id, "cancelled", time.time(), only_from=ACTIVE)
+
+    async def _run(self):
+        while True:
+            try:
+                # Oldest first; jobs left "running" by a restart come back too.
+                pending = [
+                    job
+                    for job in db.list_jobs(ACTIVE)
+                    if self.owns is None or self.owns(int(job["guild_id"]))
+                ]
+                if not pending:
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), job_recheck)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wake.clear()
+                    continue
+                await self._run_job(pending[-1])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Job runner failed: {e!r}")
+                await asyncio.sleep(60)
+
+    async def _run_job(self, job):
+        task = asyncio.create_task(self._execute(job))
+        self._running = (job["id"], task)
+        try:
+            await asyncio.wait([task])
+        finally:
+            self._running = None
+
+        # Only a job still running here is finished; one cancelled from
+        # another process keeps its status.
+        running = ("running",)
+        if task.cancelled():
+            db.set_job_status(job["id"], "cancelled", time.time(), only_from=running)
+        elif task.exception() is not None:
+            db.set_job_status(
+                job["id"],
+                "failed",
+                time.time(),
+                error=repr(task.exception()),
+                only_from=running,
+            )
+        else:
+            db.set_job_status(job["id"], "done", time.time(), only_from=running)
+        await self._notify(db.get_job(job["id"]))
+
+    async def _execute(self, job):
+        guild = self.client.get_guild(int(job["guild_id"]))
+        if guild is None:
+            raise RuntimeError("The bot is no longer in this server")
+        worker, prepare = self.handlers[job["kind"]](guild, job["params"])
+        concurrency = job["params"].get("concurrency", job_concurrency)
+        if not db.set_job_status(job["id"], "running", time.time(), only_from=ACTIVE):
+            return
+
+        cursor = job["cursor"]
+        counts = {key: job[key] for key in ("succeeded", "skipped", "failed")}
+        errors = job["errors"]
+        total = job["total"] or db.count_verified_users()
+        while True:
+            if db.get_job(job["id"])["status"] != "running":
+                # Cancelled from another process.
+                return
+            users = db.get_verified_users_page(cursor, self.page_size)
+            if not users:
+                return
+            ctx = do.FetchContext()
+            if prepare is not None:
+                await prepare(users, ctx)
+            result = await bulk.run_bulk(
+                users,
+                lambda user: worker(user, ctx),
+                concurrency=concurrency,
+                label=lambda user: f"Discord ID {user[1]}",
+            )
+            for key in counts:
+                counts[key] += getattr(result, key)
+            errors = (errors + [list(error) for error in result.errors])[
+                :job_max_errors
+            ]
+            cursor = users[-1][0]
+            db.checkpoint_job(
+                job["id"],
+                cursor,
+                max(total, sum(counts.values())),
+                counts["succeeded"],
+                counts["skipped"],
+                counts["failed"],
+                errors,
+                time.time(),
+            )
+
+    async def _notify(self, job):
+        if job["channel_id"] is None:
+            return
+        text = f"Job {describe(job)}."
+        for label, error in job["errors"][:5]:
+            text += f"\n- {label}: {error}"
+        try:
+            channel = self.client.get_channel(int(job["channel_id"]))
+            if channel is None:
+                channel = await self.client.fetch_channel(int(job["channel_id"]))
+            if self.queue is None:
+                await channel.send(content=text)
+            else:
+                await self.queue.send(channel, mutations.BACKGROUND, content=text)
+        except discord.HTTPException as e:
+            print(f"Could not report job {job['id']}: {e}")
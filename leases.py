@@ -0,0 +1,75 @@
+"""leases.py
+
+This module coordinates singleton background tasks between Democradroid
+processes through leases in the shared database.
+"""
+
+import asyncio
+import os
+import socket
+import time
+import uuid
+
+import database as db
+
+# Seconds a lease stays valid without renewal.
+lease_ttl = 30
+# Seconds between two renewal attempts; well below lease_ttl.
+lease_renew_interval = 10
+
+# Identifies this process as a lease owner.
+owner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseKeeper:
+    """Runs a task only while this process holds a named lease.
+
+    The lease is taken or renewed every ``lease_renew_interval`` seconds.
+    ``on_acquire`` is called when it is gained and ``on_release`` when it is
+    lost or given up, so at most one process runs the task at a time and a
+    crashed holder is replaced once its lease expires.
+
+    Args:
+        name (str): The lease name, shared by every process.
+        on_acquire (callable): Called with no arguments to start the task.
+        on_release (callable): Called with no arguments to stop the task.
+        ttl (float): Seconds the lease stays valid without renewal.
+    """
+
+    def __init__(self, name, on_acquire, on_release, ttl=None):
+        self.name = name
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.ttl = ttl or lease_ttl
+        self.held = False
+        self._task = None
+
+    def start(self):
+        """Starts competing for the lease unless already doing so."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """Stops the task and gives up the lease."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._set_held(False)
+        db.release_lease(self.name, owner_id)
+
+    def _set_held(self, held):
+        if held == self.held:
+            return
+        self.held = held
+        print(f"{'Acquired' if held else 'Lost'} lease {self.name}.")
+        (self.on_acquire if held else self.on_release)()
+
+    async def _run(self):
+        while True:
+            try:
+                held = db.acquire_lease(self.name, owner_id, self.ttl, time.time())
+            except Exception as e:
+                print(f"Could not renew lease {self.name}: {e!r}")
+                held = False
+            self._set_held(held)
+            await asyncio.sleep(lease_renew_interval)
@@ -0,0 +1,256 @@
+"""metrics.py
+
+This module collects runtime metrics for the Democradroid bot and serves them
+in the Prometheus text format.
+"""
+
+import asyncio
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# Address the Prometheus endpoint listens on. Keep it local.
+metrics_host = "127.0.0.1"
+metrics_port = 9108
+# Seconds between two event-loop lag measurements.
+loop_lag_interval = 1.0
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = []
+_collectors = []
+_runner = None
+_lag_task = None
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Counts observations into cumulative buckets.
+
+    Args:
+        name (str): The metric name.
+        help (str): The help text.
+        labels (tuple): The label names.
+        buckets (tuple): The bucket upper bounds, ascending.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][index] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the wall time spent in a ``with`` block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, q, **labels):
+        """Estimates a quantile as the upper bound of the bucket it falls in.
+
+        Returns:
+            float: The estimate, inf if beyond the last bucket, or None if
+            nothing was observed.
+        """
+        entry = self.values.get(self._key(labels))
+        if entry is None or entry[2] == 0:
+            return None
+        target = q * entry[2]
+        seen = 0
+        for bound, count in zip(self.buckets, entry[0]):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def summary(self):
+        """Returns count, mean, p50 and p95 per label set."""
+        result = {}
+        for key, (_, total, count) in self.values.items():
+            labels = dict(zip(self.labels, key))
+            result[key] = {
+                "count": count,
+                "mean": total / count if count else 0.0,
+                "p50": self.quantile(0.5, **labels),
+                "p95": self.quantile(0.95, **labels),
+            }
+        return result
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                labels = _format_labels(self.labels, key, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+command_seconds = Histogram(
+    "democradroid_command_seconds",
+    "Slash command latency from interaction creation to completion.",
+    ("command", "outcome"),
+)
+api_requests = Counter(
+    "democradroid_api_requests_total",
+    "democracyonline.io HTTP requests sent.",
+    ("endpoint", "status"),
+)
+api_seconds = Histogram(
+    "democradroid_api_seconds",
+    "democracyonline.io HTTP request latency.",
+    ("endpoint",),
+)
+db_seconds = Histogram(
+    "democradroid_db_seconds",
+    "Time spent in database.py functions.",
+    ("function",),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1),
+)
+loop_lag_seconds = Histogram(
+    "democradroid_event_loop_lag_seconds",
+    "How late the event loop wakes up a sleeping task.",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+
+def register_collector(collect):
+    """Registers a callable run at scrape time to refresh gauges.
+
+    Args:
+        collect (callable): Function taking no arguments.
+    """
+    _collectors.append(collect)
+
+
+def render():
+    """Renders every metric in the Prometheus text format.
+
+    Returns:
+        str: The exposition text.
+    """
+    for collect in _collectors:
+        try:
+            collect()
+        except Exception as e:
+            print(f"Metrics collector failed: {e!r}")
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def _watch_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(loop_lag_interval)
+        loop_lag_seconds.observe(max(0.0, loop.time() - started - loop_lag_interval))
+
+
+async def start(host=None, port=None):
+    """Starts the Prometheus endpoint and the event-loop lag monitor.
+
+    Calling it again while running does nothing.
+
+    Args:
+        host (str): The address to listen on. Defaults to ``metrics_host``.
+        port (int): The port to listen on. Defaults to ``metrics_port``.
+    """
+    global _runner, _lag_task
+    if _lag_task is None or _lag_task.done():
+        _lag_task = asyncio.create_task(_watch_loop_lag())
+    if _runner is None:
+        app = web.Application()
+        app.router.add_get("/metrics", _handle_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host or metrics_host, port or metrics_port).start()
+        _runner = runner
+
+
+async def stop():
+    """Stops the Prometheus endpoint and the event-loop lag monitor."""
+    global _runner, _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        _lag_task = None
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
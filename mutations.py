@@ -0,0 +1,259 @@
+"""mutations.py
+
+This module queues Discord mutations (role edits, role creation, role
+moves and channel messages) for the Democradroid bot, so interactive
+commands always run ahead of background jobs and rate limits are respected
+before requests are sent.
+"""
+
+import asyncio
+import itertools
+import time
+
+# Priorities, lower runs first.
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Requests allowed per period for each kind of route, kept a little below
+# Discord's published limits so requests are rarely answered with a 429.
+route_limits = {
+    "member_edit": (8, 10.0),
+    "role_create": (4, 10.0),
+    "role_positions": (2, 10.0),
+    "channel_send": (4, 5.0),
+}
+# Number of mutations sent to Discord at once.
+queue_workers = 4
+
+
+class _Bucket:
+    # Token bucket for one route.
+
+    def __init__(self, rate, period):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.refill = rate / period
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        # Takes a token and returns 0, or returns the seconds until one is free.
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.refill
+
+
+class _Mutation:
+    # A queued operation and the future its callers wait on.
+
+    def __init__(self, kind, route, priority, run):
+        self.kind = kind
+        self.route = route
+        self.priority = priority
+        self.run = run
+        self.future = asyncio.get_running_loop().create_future()
+        # Retrieve the outcome even if every caller stopped waiting.
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.enqueued = time.monotonic()
+        self.done = False
+
+
+class MutationQueue:
+    """Priority queue that sends Discord mutations from a pool of workers.
+
+    Interactive work always runs before background work. Every route has a
+    local token bucket: a mutation whose bucket is empty is set aside until
+    a token is free, so other routes keep flowing meanwhile. Pending role
+    edits for the same member are merged into one edit.
+
+    Args:
+        workers (int): The number of mutations sent at once.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or queue_workers
+        self._queue = None
+        self._tasks = []
+        self._seq = itertools.count()
+        self._buckets = {}
+        self._pending_edits = {}
+        self._deferred = 0
+        self.stats = {
+            "queued": 0,
+            "merged": 0,
+            "sent": {INTERACTIVE: 0, BACKGROUND: 0},
+            "failed": 0,
+            "rate_limited": 0,
+            "wait_total": {INTERACTIVE: 0.0, BACKGROUND: 0.0},
+            "wait_max": {INTERACTIVE: 0.0, BACKGROUND: 0.0},
+        }
+
+    def start(self):
+        """Starts the workers unless they are already running."""
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    def depth(self):
+        """Returns the number of mutations waiting to be sent."""
+        return (self._queue.qsize() if self._queue else 0) + self._deferred
+
+    def summary(self):
+        """Returns queue depth and wait-time stats as a dict."""
+        stats = dict(self.stats, depth=self.depth())
+        stats["wait_avg"] = {
+            priority: stats["wait_total"][priority] / sent if sent else 0.0
+            for priority, sent in stats["sent"].items()
+        }
+        return stats
+
+    def _put(self, mutation):
+        self._queue.put_nowait((mutation.priority, next(self._seq), mutation))
+
+    def _submit(self, mutation):
+        self.start()
+        self.stats["queued"] += 1
+        self._put(mutation)
+        return mutation.future
+
+    def has_pending_edit(self, member):
+        """Returns whether a role edit for the member is waiting to be sent."""
+        pending = self._pending_edits.get((member.guild.id, member.id))
+        return pending is not None and not pending.done
+
+    async def edit_roles(self, member, add, remove, reason=None, priority=BACKGROUND):
+        """Queues adding and removing roles on a member.
+
+        If an edit for the member is already pending, the two are merged into
+        a single edit, which runs at the higher of the two priorities. The
+        final role list is computed from the member's roles when it is sent.
+
+        Args:
+            member (discord.Member): The member to edit.
+            add (list): Roles to add.
+            remove (list): Roles to remove.
+            reason (str): The audit log reason.
+            priority (int): ``INTERACTIVE`` or ``BACKGROUND``.
+        Returns:
+            bool: True if the member was edited.
+        """
+        key = (member.guild.id, member.id)
+        add = {role.id: role for role in add}
+        remove = {role.id: role for role in remove}
+        pending = self._pending_edits.get(key)
+        if pending is not None and not pending.done:
+            self.stats["merged"] += 1
+            for role_id in add:
+                pending.remove.pop(role_id, None)
+            for role_id in remove:
+                pending.add.pop(role_id, None)
+            pending.add.update(add)
+            pending.remove.update(remove)
+            if priority < pending.priority:
+                # Requeue at the higher priority; the old entry is skipped.
+                pending.priority = priority
+                self._put(pending)
+            return await asyncio.shield(pending.future)
+
+        async def run():
+            if self._pending_edits.get(key) is mutation:
+                del self._pending_edits[key]
+            current = [role for role in member.roles if not role.is_default()]
+            roles = {
+                role.id: role for role in current if role.id not in mutation.remove
+            }
+            roles.update(mutation.add)
+            if set(roles) == {role.id for role in current}:
+                return False
+            await member.edit(roles=list(roles.values()), reason=reason)
+            return True
+
+        mutation = _Mutation(
+            "member_edit", ("member_edit", member.guild.id), priority, run
+        )
+        mutation.add = add
+        mutation.remove = remove
+        self._pending_edits[key] = mutation
+        return await asyncio.shield(self._submit(mutation))
+
+    async def create_role(self, guild, priority=BACKGROUND, **kwargs):
+        """Queues ``guild.create_role(**kwargs)`` and returns the new role."""
+        mutation = _Mutation(
+            "role_create",
+            ("role_create", guild.id),
+            priority,
+            lambda: guild.create_role(**kwargs),
+        )
+        return await asyncio.shield(self._submit(mutation))
+
+    async def edit_role_positions(
+        self, guild, positions, priority=BACKGROUND, reason=None
+    ):
+        """Queues ``guild.edit_role_positions`` for a role -> position map."""
+        mutation = _Mutation(
+            "role_positions",
+            ("role_positions", guild.id),
+            priority,
+            lambda: guild.edit_role_positions(positions=positions, reason=reason),
+        )
+        return await asyncio.shield(self._submit(mutation))
+
+    async def send(self, channel, priority=BACKGROUND, **kwargs):
+        """Queues ``channel.send(**kwargs)`` and returns the message."""
+        mutation = _Mutation(
+            "channel_send",
+            ("channel_send", channel.id),
+            priority,
+            lambda: channel.send(**kwargs),
+        )
+        return await asyncio.shield(self._submit(mutation))
+
+    def _bucket(self, route):
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            bucket = self._buckets[route] = _Bucket(*route_limits[route[0]])
+        return bucket
+
+    def _requeue_later(self, mutation, delay):
+        self._deferred += 1
+
+        def requeue():
+            self._deferred -= 1
+            self._put(mutation)
+
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def _worker(self):
+        while True:
+            priority, _, mutation = await self._queue.get()
+            # Stale entry of a mutation that was requeued at a higher priority.
+            if mutation.done or priority != mutation.priority:
+                continue
+            delay = self._bucket(mutation.route).reserve()
+            if delay > 0:
+                self.stats["rate_limited"] += 1
+                self._requeue_later(mutation, delay)
+                continue
+
+            mutation.done = True
+            waited = time.monotonic() - mutation.enqueued
+            self.stats["sent"][mutation.priority] += 1
+            self.stats["wait_total"][mutation.priority] += waited
+            self.stats["wait_max"][mutation.priority] = max(
+                self.stats["wait_max"][mutation.priority], waited
+            )
+            try:
+                result = await mutation.run()
+            except Exception as e:
+                self.stats["failed"] += 1
+                if not mutation.future.done():
+                    mutation.future.set_exception(e)
+            else:
+                if not mutation.future.done():
+                    mutation.future.set_result(result)
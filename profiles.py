@@ -0,0 +1,136 @@
+"""profiles.py
+
+This module serves DemocracyOnline users and parties from a persistent
+stale-while-revalidate cache for the Democradroid bot.
+"""
+
+import asyncio
+import time
+
+import database as db
+import dofuncs as do
+
+# Seconds a cached record is served without refreshing it.
+profile_fresh_seconds = 300
+# Seconds a cached record may be served at all. Older records are fetched
+# before answering, unless the fetch fails.
+profile_max_staleness = 24 * 3600
+# Seconds a cached record is kept at all, as a fallback when fetches fail.
+profile_retention = 7 * 24 * 3600
+# Seconds between two prunes of records older than profile_retention.
+prune_interval = 3600
+
+_refreshing = {}
+_last_prune = 0.0
+
+
+async def _fetch(kind, key, budget=None):
+    if kind == "user":
+        return await do.fetch_user_async(key, budget=budget)
+    # Bypass the in-memory party cache so fetched_at is the real fetch time.
+    return await do.get_party(key, refresh=True, budget=budget)
+
+
+async def _refresh(kind, key, budget=None):
+    global _last_prune
+    data = await _fetch(kind, key, budget)
+    if isinstance(data, dict):
+        now = time.time()
+        db.set_cached_profile(kind, key, data, now)
+        if now - _last_prune >= prune_interval:
+            _last_prune = now
+            db.prune_profile_cache(now - profile_retention)
+    return data
+
+
+def _refresh_later(kind, key):
+    # One background refresh per record at a time.
+    if (kind, key) in _refreshing:
+        return
+    task = asyncio.create_task(_refresh(kind, key))
+    _refreshing[(kind, key)] = task
+
+    def done(task):
+        del _refreshing[(kind, key)]
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Could not refresh {kind} {key}: {task.exception()!r}")
+
+    task.add_done_callback(done)
+
+
+async def _lookup(kind, key, budget=None):
+    key = str(key)
+    cached = db.get_cached_profile(kind, key)
+    if cached is not None:
+        data, fetched_at = cached
+        age = max(0.0, time.time() - fetched_at)
+        if age <= profile_max_staleness:
+            if age > profile_fresh_seconds:
+                _refresh_later(kind, key)
+            return data, age
+
+    data = await _refresh(kind, key, budget)
+    if isinstance(data, dict):
+        return data, 0.0
+    if cached is not None:
+        # Too old to serve normally, but better than nothing.
+        return cached[0], max(0.0, time.time() - cached[1])
+    return None, None
+
+
+async def get_user(democracyonline_id, ctx=None):
+    """Returns a DemocracyOnline user, answering from the cache when possible.
+
+    A cached record younger than ``profile_max_staleness`` is returned
+    straight away; if it is older than ``profile_fresh_seconds`` it is also
+    refreshed in the background. Otherwise the user is fetched first.
+
+    Args:
+        democracyonline_id (str): The ID of the user.
+        ctx (dofuncs.FetchContext): If given, its budget bounds any fetch,
+            and a fresh record is stored in it so later helpers do not
+            fetch it again.
+    Returns:
+        tuple: The user data, or None if it could not be fetched, and its
+        age in seconds.
+    """
+    data, age = await _lookup("user", democracyonline_id, ctx and ctx.budget)
+    if ctx is not None and data is not None and age <= profile_fresh_seconds:
+        ctx.users[str(democracyonline_id)] = data
+    return data, age
+
+
+async def get_party(party_id, ctx=None):
+    """Returns a DemocracyOnline party, answering from the cache when possible.
+
+    See ``get_user``.
+
+    Args:
+        party_id (str): The ID of the party.
+        ctx (dofuncs.FetchContext): If given, its budget bounds any fetch,
+            and a fresh record is stored in it.
+    Returns:
+        tuple: The party data, or None if it could not be fetched, and its
+        age in seconds.
+    """
+    data, age = await _lookup("party", party_id, ctx and ctx.budget)
+    if ctx is not None and data is not None and age <= profile_fresh_seconds:
+        ctx.parties[str(party_id)] = data
+    return data, age
+
+
+def describe_age(age):
+    """Returns how old data is, for display.
+
+    Args:
+        age (float): The age in seconds.
+    """
+    if age < 60:
+        return "just now"
+    if age < 3600:
+        minutes = int(age // 60)
+        return f"{minutes} minute{'s' if minutes != 1 else ''} ago"
+    if age < 2 * 86400:
+        hours = int(age // 3600)
+        return f"{hours} hour{'s' if hours != 1 else ''} ago"
+    return f"{int(age // 86400)} days ago"
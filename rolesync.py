@@ -0,0 +1,120 @@
+"""rolesync.py
+
+This module runs the background role-sync daemon for the Democradroid bot.
+"""
+
+import asyncio
+import time
+
+import bulk
+import database as db
+import dofuncs as do
+
+# Seconds between two sync batches.
+sync_interval = 60
+# Number of verified users re-checked per batch.
+sync_batch_size = 25
+# Number of users checked at once within a batch.
+sync_concurrency = 4
+
+
+class RoleSyncDaemon:
+    """Periodically re-checks verified users and fixes drifted roles.
+
+    Each batch re-fetches the least recently checked users and compares
+    their party and job with the state stored in ``user_state``. Discord is
+    only touched for users whose state changed, or was never recorded.
+
+    Roles are only applied in the guilds of this process's shards, so the
+    state is tracked separately per shard scope.
+
+    Args:
+        client (discord.Client): The bot client, used to find guilds.
+        apply (callable): Coroutine function called as
+            ``apply(guild, discord_id, democracyonline_id, ctx)`` to update a
+            member's roles in one guild.
+        interval (float): Seconds between batches.
+        batch_size (int): Number of users checked per batch.
+        scope (str): The shard scope the state is tracked under.
+    """
+
+    def __init__(self, client, apply, interval=None, batch_size=None, scope="all"):
+        self.client = client
+        self.apply = apply
+        self.interval = interval or sync_interval
+        self.batch_size = batch_size or sync_batch_size
+        self.scope = scope
+        self.stats = {"checked": 0, "changed": 0, "applied": 0, "failed": 0}
+        self._task = None
+
+    def start(self):
+        """Starts the daemon unless it is already running."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """Stops the daemon."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Role sync batch failed: {e!r}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        """Checks one batch of users.
+
+        Returns:
+            bulk.BulkResult: The counters of the batch.
+        """
+        users = db.get_users_to_sync(self.batch_size, self.scope)
+        ctx = do.FetchContext()
+        await ctx.prefetch_users([user[2] for user in users])
+        result = await bulk.run_bulk(
+            users,
+            lambda user: self._check(user, ctx),
+            concurrency=sync_concurrency,
+            label=lambda user: user[1],
+        )
+        self.stats["checked"] += result.done
+        self.stats["failed"] += result.failed
+        return result
+
+    async def _check(self, user, ctx):
+        user_id, discord_id, democracyonline_id, party_id, role, checked_at = user
+        do_user_info = await ctx.user(democracyonline_id)
+        if not isinstance(do_user_info, dict):
+            # Keep the old state but move the user to the back of the queue.
+            db.set_user_state(user_id, party_id, role, time.time(), self.scope)
+            error = ctx.errors.get(str(democracyonline_id))
+            raise bulk.Skip(
+                f"Could not fetch DemocracyOnline ID {democracyonline_id}"
+                + (f": {error.status} {error.detail}" if error else "")
+            )
+
+        new_party_id = do_user_info.get("partyId")
+        new_party_id = str(new_party_id) if new_party_id is not None else None
+        new_role = do_user_info.get("role")
+        if checked_at is not None and (new_party_id, new_role) == (party_id, role):
+            db.set_user_state(user_id, party_id, role, time.time(), self.scope)
+            return
+
+        self.stats["changed"] += 1
+        for guild in self.client.guilds:
+            # Only guilds the member is known to be in; no REST lookups here.
+            if guild.get_member(int(discord_id)) is None:
+                continue
+            try:
+                await self.apply(guild, discord_id, democracyonline_id, ctx)
+            except Exception:
+                # Keep the old state so the change is retried, but move the
+                # user to the back of the queue so failures cannot starve it.
+                db.set_user_state(user_id, party_id, role, time.time(), self.scope)
+                raise
+            self.stats["applied"] += 1
+        db.set_user_state(user_id, new_party_id, new_role, time.time(), self.scope)
@@ -0,0 +1,341 @@
+"""scheduler.py
+
+This module schedules the daily game-state updates for the Democradroid bot.
+"""
+
+import asyncio
+import re
+import time as clock
+from datetime import datetime, time, timedelta, timezone
+
+import discord
+
+import database as db
+import dofuncs as do
+import mutations
+
+# Default UTC time of day the game-state update is posted at.
+default_post_time = "20:05"
+# Seconds before a post time at which the game state is fetched.
+warmup_seconds = 120
+# Seconds between re-reads of the subscriptions, which other processes may
+# change without being able to wake this scheduler.
+subscription_recheck = 60
+
+
+def parse_post_time(value):
+    """Parses a "HH:MM" UTC time of day.
+
+    Args:
+        value (str): The time of day.
+    Returns:
+        str: The normalised "HH:MM" time, or None if it is not valid.
+    """
+    try:
+        parsed = datetime.strptime(value.strip(), "%H:%M").time()
+    except ValueError:
+        return None
+    return parsed.strftime("%H:%M")
+
+
+def next_occurrence(post_time, after):
+    """Returns the first time a daily "HH:MM" UTC slot falls after a moment.
+
+    Args:
+        post_time (str): The "HH:MM" time of day.
+        after (datetime.datetime): An aware datetime.
+    Returns:
+        datetime.datetime: The next occurrence, in UTC.
+    """
+    hour, minute = map(int, post_time.split(":"))
+    after = after.astimezone(timezone.utc)
+    target = datetime.combine(after.date(), time(hour, minute), tzinfo=timezone.utc)
+    if target <= after:
+        target += timedelta(days=1)
+    return target
+
+
+def game_state_embed(data):
+    """Renders game state data as an embed.
+
+    Args:
+        data (dict): The game state data from ``dofuncs``.
+    Returns:
+        discord.Embed: The embed.
+    """
+    # Consists of a dict with:
+    # - Current election statuses senate and presidential
+    # - Current House Bills
+    # - Current Senate Bills
+    # - Current Presidential Bills
+
+    embed = discord.Embed(
+        title="Current DemocracyOnline Game State", color=discord.Color.purple()
+    )
+    # Add election statuses
+    embed.add_field(
+        name="Senate Election Status",
+        value=data["senate_election"],
+        inline=False,
+    )
+    embed.add_field(
+        name="Presidential Election Status",
+        value=data["president_election"],
+        inline=False,
+    )
+    embed.add_field(
+        name="Current House Bills",
+        value=(
+            "\n".join(data["current_house_bills"])
+            if data["current_house_bills"]
+            else "None"
+        ),
+        inline=False,
+    )
+    embed.add_field(
+        name="Current Senate Bills",
+        value=(
+            "\n".join(data["current_senate_bills"])
+            if data["current_senate_bills"]
+            else "None"
+        ),
+        inline=False,
+    )
+    embed.add_field(
+        name="Current Presidential Bills",
+        value=(
+            "\n".join(data["current_presidential_bills"])
+            if data["current_presidential_bills"]
+            else "None"
+        ),
+        inline=False,
+    )
+    return embed
+
+
+_bill_stages = {
+    "current_house_bills": "House",
+    "current_senate_bills": "Senate",
+    "current_presidential_bills": "Presidential",
+}
+# Rendered election field -> (raw status field, name). The rendered text
+# includes the days-left countdown, so changes are detected on the status.
+_elections = {
+    "senate_election": ("senate_status", "Senate Election"),
+    "president_election": ("president_status", "Presidential Election"),
+}
+
+
+def _bill_key(bill):
+    # Bills are rendered as "#<id> - <title>"; fall back to the whole string.
+    match = re.match(r"#(\d+)", str(bill))
+    return match.group(1) if match else str(bill)
+
+
+def _bill_stage_map(data):
+    stages = {}
+    for field, stage in _bill_stages.items():
+        bills = data.get(field)
+        if isinstance(bills, list):
+            for bill in bills:
+                stages[_bill_key(bill)] = (stage, bill)
+    return stages
+
+
+def diff_game_state(old, new):
+    """Compares two game states.
+
+    Args:
+        old (dict): The previously announced game state, or None.
+        new (dict): The current game state.
+    Returns:
+        dict: ``new_bills`` as (stage, bill) pairs, ``moved_bills`` as
+        (bill, old stage, new stage) triples and ``elections`` as
+        (election, new status) pairs. All are empty if nothing changed.
+    """
+    changes = {"new_bills": [], "moved_bills": [], "elections": []}
+    old = old or {}
+    old_stages = _bill_stage_map(old)
+    for key, (stage, bill) in _bill_stage_map(new).items():
+        if key not in old_stages:
+            changes["new_bills"].append((stage, bill))
+        elif old_stages[key][0] != stage:
+            changes["moved_bills"].append((bill, old_stages[key][0], stage))
+    for field, (status, name) in _elections.items():
+        if new.get(status) != old.get(status):
+            changes["elections"].append((name, new.get(field)))
+    return changes
+
+
+def has_changes(changes):
+    """Returns whether a ``diff_game_state`` result contains any change."""
+    return any(changes.values())
+
+
+def changes_embed(changes):
+    """Renders a ``diff_game_state`` result as a compact embed.
+
+    Args:
+        changes (dict): The changes.
+    Returns:
+        discord.Embed: The embed.
+    """
+    embed = discord.Embed(title="What Changed", color=discord.Color.purple())
+    if changes["elections"]:
+        embed.add_field(
+            name="Elections",
+            value="\n".join(
+                f"{name}: {status}" for name, status in changes["elections"]
+            ),
+            inline=False,
+        )
+    if changes["new_bills"]:
+        embed.add_field(
+            name="New Bills",
+            value="\n".join(
+                f"{bill} ({stage})" for stage, bill in changes["new_bills"]
+            ),
+            inline=False,
+        )
+    if changes["moved_bills"]:
+        embed.add_field(
+            name="Bills Moved",
+            value="\n".join(
+                f"{bill}: {old} -> {new}" for bill, old, new in changes["moved_bills"]
+            ),
+            inline=False,
+        )
+    return embed
+
+
+class GameUpdateScheduler:
+    """Posts the game-state update to every subscribed channel.
+
+    Subscriptions live in the ``game_updates`` table, so they survive
+    restarts. For each post time the game state is fetched once, shortly
+    before the slot, and the rendered embed is sent to every channel
+    subscribed to that slot.
+
+    Snapshots are kept per post time, not per channel: a slot whose game
+    state has not changed is skipped for every channel subscribed to it,
+    including ones that subscribed since its last post. /gameupdate posts
+    the current state when a channel subscribes, so those channels start
+    from the same state.
+
+    Args:
+        client (discord.Client): The bot client, used to find channels.
+        queue (mutations.MutationQueue): If given, posts are sent through it
+            as background work.
+    """
+
+    def __init__(self, client, queue=None):
+        self.client = client
+        self.queue = queue
+        self._task = None
+        self._wake = asyncio.Event()
+        self._last_slot = None
+
+    def start(self):
+        """Starts the scheduler unless it is already running."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """Stops the scheduler."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def reschedule(self):
+        """Makes the scheduler re-read its subscriptions."""
+        self._wake.set()
+
+    async def _sleep_until(self, moment):
+        # Returns False if woken early by reschedule().
+        delay = (moment - datetime.now(timezone.utc)).total_seconds()
+        if delay <= 0:
+            return True
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            return True
+        self._wake.clear()
+        return False
+
+    async def _run(self):
+        while True:
+            try:
+                await self._tick()
+            except Exception as e:
+                print(f"Game update tick failed: {e!r}")
+                await asyncio.sleep(60)
+
+    async def _tick(self):
+        now = datetime.now(timezone.utc)
+        recheck = now + timedelta(seconds=subscription_recheck)
+        updates = db.list_game_updates()
+        if not updates:
+            await self._sleep_until(recheck)
+            return
+
+        after = now
+        if self._last_slot is not None and self._last_slot > after:
+            after = self._last_slot
+        slot = min(next_occurrence(update[3], after) for update in updates)
+
+        warmup = slot - timedelta(seconds=warmup_seconds)
+        if not await self._sleep_until(min(warmup, recheck)) or recheck < warmup:
+            return
+        data = await do.fetch_game_state_data_async()
+        if not await self._sleep_until(slot):
+            return
+        self._last_slot = slot
+
+        post_time = slot.strftime("%H:%M")
+        due = [update for update in db.list_game_updates() if update[3] == post_time]
+        if "error" in data:
+            print(f"Skipping game update at {post_time}: {data['error']}")
+            return
+
+        # Only announce, and ping, when something changed since the last post.
+        previous = db.get_latest_game_snapshot(post_time)
+        changes = diff_game_state(previous, data)
+        if previous is not None and not has_changes(changes):
+            print(f"No game state changes at {post_time}, skipping update.")
+            return
+        db.add_game_snapshot(post_time, data, clock.time())
+
+        embed = game_state_embed(data)
+        delta = changes_embed(changes) if previous is not None else None
+        await asyncio.gather(*(self.post(update, embed, delta) for update in due))
+
+    async def post(self, update, embed, delta=None):
+        """Sends an embed to a subscribed channel, pinging its role if set.
+
+        Args:
+            update (tuple): A row from ``database.list_game_updates``.
+            embed (discord.Embed): The embed to send.
+            delta (discord.Embed): The "what changed" embed, sent to channels
+                that asked for it.
+        """
+        channel_id, guild_id, role_id, post_time, show_changes = update
+        embeds = [embed, delta] if delta is not None and show_changes else [embed]
+        try:
+            channel = self.client.get_channel(int(channel_id))
+            if channel is None:
+                channel = await self.client.fetch_channel(int(channel_id))
+            if role_id is not None:
+                await self._send(
+                    channel, content=f"<@&{role_id}> Here is the latest game update."
+                )
+            await self._send(channel, embeds=embeds)
+        except discord.NotFound:
+            print(f"Channel {channel_id} no longer exists, removing its game update.")
+            db.remove_game_update(channel_id)
+        except discord.HTTPException as e:
+            print(f"Could not post game update to channel {channel_id}: {e}")
+
+    async def _send(self, channel, **kwargs):
+        if self.queue is None:
+            return await channel.send(**kwargs)
+        return await self.queue.send(channel, mutations.BACKGROUND, **kwargs)
@@ -0,0 +1,47 @@
+import unittest
+
+import dofuncs as do
+import scheduler
+
+
+def game_state(president_status, president_days, senate_status, senate_days):
+    # A raw game-state payload as returned by the API, parsed like the bot does.
+    return do._parse_game_state(
+        [
+            {
+                "status": president_status,
+                "daysLeft": president_days,
+                "bills_voting": ["#1 - Budget"],
+            },
+            {
+                "status": senate_status,
+                "daysLeft": senate_days,
+                "bills_voting": ["#2 - Roads"],
+                "house_bills_voting": ["#3 - Parks"],
+            },
+        ]
+    )
+
+
+class DiffGameStateTest(unittest.TestCase):
+    def test_countdown_only_is_not_a_change(self):
+        old = game_state("Voting", 3, "Concluded", 6)
+        new = game_state("Voting", 2, "Concluded", 5)
+        self.assertNotEqual(old["president_election"], new["president_election"])
+        changes = scheduler.diff_game_state(old, new)
+        self.assertFalse(scheduler.has_changes(changes))
+
+    def test_status_change_is_reported(self):
+        old = game_state("Candidate", 1, "Concluded", 6)
+        new = game_state("Voting", 3, "Concluded", 5)
+        changes = scheduler.diff_game_state(old, new)
+        self.assertEqual(
+            changes["elections"],
+            [("Presidential Election", new["president_election"])],
+        )
+        self.assertEqual(changes["new_bills"], [])
+        self.assertEqual(changes["moved_bills"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""verifier.py
+
+This module completes pending DemocracyOnline verifications in the
+background for the Democradroid bot.
+"""
+
+import asyncio
+import time
+
+import bulk
+import database as db
+import dofuncs as do
+
+# Seconds a verification code stays valid.
+code_ttl = db.verification_code_ttl
+# Seconds between two polls.
+poll_interval = 30
+# Number of pending verifications checked per poll.
+poll_batch_size = 50
+# Number of pending verifications completed at once within a poll.
+poll_concurrency = 4
+
+
+class VerificationPoller:
+    """Checks pending users' bios for their code and completes verification.
+
+    Each poll first deletes links whose code has expired, then checks the
+    least recently checked pending verifications, fetching their profiles
+    in one batch. Polling a bounded batch at a steady interval spreads the
+    lookups out instead of leaving them to users retrying /verify.
+
+    Args:
+        complete (callable): Coroutine function called as
+            ``complete(pending, ctx)`` once a user is marked verified, to
+            assign roles and notify them. ``pending`` is a row from
+            ``database.get_pending_verifications``.
+        interval (float): Seconds between polls.
+        batch_size (int): Number of pending verifications checked per poll.
+    """
+
+    def __init__(self, complete, interval=None, batch_size=None):
+        self.complete = complete
+        self.interval = interval or poll_interval
+        self.batch_size = batch_size or poll_batch_size
+        self.stats = {"checked": 0, "verified": 0, "purged": 0}
+        self._task = None
+
+    def start(self):
+        """Starts the poller unless it is already running."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """Stops the poller."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Verification poll failed: {e!r}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        """Purges expired codes and checks one batch of pending verifications.
+
+        Returns:
+            bulk.BulkResult: The counters of the batch; verified users count
+            as succeeded, the rest as skipped.
+        """
+        now = time.time()
+        self.stats["purged"] += db.purge_expired_verifications(now)
+        pending = db.get_pending_verifications(now, self.batch_size)
+        ctx = do.FetchContext()
+        await ctx.prefetch_users([row[2] for row in pending])
+        result = await bulk.run_bulk(
+            pending,
+            lambda row: self._check(row, ctx),
+            concurrency=poll_concurrency,
+            label=lambda row: f"Discord ID {row[1]}",
+        )
+        db.mark_verifications_checked([row[0] for row in pending], time.time())
+        self.stats["checked"] += result.done
+        return result
+
+    async def _check(self, pending, ctx):
+        user_id, discord_id, democracyonline_id, code = pending[:4]
+        do_user_info = await ctx.user(democracyonline_id)
+        if not isinstance(do_user_info, dict):
+            raise bulk.Skip(f"Could not fetch DemocracyOnline ID {democracyonline_id}")
+        if code not in str(do_user_info.get("bio") or ""):
+            raise bulk.Skip("Code not in bio yet")
+        db.set_user_verified(user_id)
+        self.stats["verified"] += 1
+        await self.complete(pending, ctx)
@@ -0,0 +1,206 @@
+"""worker.py
+
+Role-sync worker process for the Democradroid bot.
+
+Claims the role sync tasks queued by a gateway process started with
+``--sync-workers`` and applies them over Discord's REST API. A worker never
+connects to the gateway, so as many can run as the rate limits allow:
+
+    python worker.py --concurrency 8
+"""
+
+import argparse
+import asyncio
+import time
+from collections import defaultdict
+
+import discord
+
+import bulk
+import database as db
+import democradroid as dd
+import dofuncs as do
+import guildfuncs as gf
+import leases
+import mutations
+
+# Number of tasks claimed at once.
+worker_batch_size = 50
+# Number of claimed tasks applied at once.
+worker_concurrency = 8
+# Seconds a worker has to finish a claimed batch before another may take it.
+task_lease_seconds = 300
+# Seconds between polls while the queue is empty.
+poll_interval = 2.0
+# Attempts made at a task before it is marked failed, and the base backoff
+# between them in seconds.
+max_attempts = 5
+retry_backoff = 30
+# Seconds a fetched guild, and its role list, is reused before refetching.
+guild_refresh_interval = 300
+
+# What each task reason updates; anything else gets both party and job roles.
+_appliers = {
+    "party_roles": dd.assign_party_role,
+    "job_roles": dd.assign_role_by_job,
+}
+
+
+class SyncWorker:
+    """Claims queued role syncs with a lease and applies them.
+
+    Each batch looks up the users' links, fetches their DemocracyOnline
+    profiles in bulk and applies the roles with the same code the gateway
+    process uses. Failed tasks are retried with exponential backoff.
+
+    Args:
+        client (discord.Client): A logged-in client. It does not need a
+            gateway connection.
+        concurrency (int): The number of tasks applied at once.
+        batch_size (int): The number of tasks claimed at once.
+    """
+
+    def __init__(self, client, concurrency=None, batch_size=None):
+        self.client = client
+        self.concurrency = concurrency or worker_concurrency
+        self.batch_size = batch_size or worker_batch_size
+        self.stats = {"claimed": 0, "applied": 0, "skipped": 0, "failed": 0}
+        self._guilds = {}
+        self._guild_locks = defaultdict(asyncio.Lock)
+
+    async def guild(self, guild_id):
+        """Returns a guild fetched over REST, refetching it periodically.
+
+        Args:
+            guild_id (int): The Discord ID of the guild.
+        Returns:
+            discord.Guild: The guild.
+        """
+        entry = self._guilds.get(guild_id)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        async with self._guild_locks[guild_id]:
+            entry = self._guilds.get(guild_id)
+            if entry is not None and entry[1] > time.monotonic():
+                return entry[0]
+            guild = await self.client.fetch_guild(guild_id)
+            # Without a gateway the guild has no member cache; add the bot's
+            # own member so guild.me, and with it role placement, works.
+            guild._add_member(await guild.fetch_member(self.client.user.id))
+            dd.role_registry.forget(guild_id)
+            self._guilds[guild_id] = (guild, time.monotonic() + guild_refresh_interval)
+            return guild
+
+    async def run(self):
+        """Processes batches until cancelled."""
+        while True:
+            try:
+                result = await self.run_once()
+            except Exception as e:
+                print(f"Sync worker batch failed: {e!r}")
+                result = None
+            if result is None:
+                await asyncio.sleep(poll_interval)
+
+    async def run_once(self):
+        """Claims and applies one batch of tasks.
+
+        Returns:
+            bulk.BulkResult: The counters of the batch, or None if no task
+            was available.
+        """
+        tasks = db.claim_sync_tasks(
+            leases.owner_id, self.batch_size, task_lease_seconds, time.time()
+        )
+        if not tasks:
+            return None
+        self.stats["claimed"] += len(tasks)
+        links = {task[0]: db.get_user_by_discord_id(task[1]) for task in tasks}
+        ctx = do.FetchContext()
+        await ctx.prefetch_users([link[2] for link in links.values() if link])
+        result = await bulk.run_bulk(
+            tasks,
+            lambda task: self._apply(task, links[task[0]], ctx),
+            concurrency=self.concurrency,
+            label=lambda task: f"Task {task[0]} ({task[3]})",
+        )
+        self.stats["applied"] += result.succeeded
+        self.stats["skipped"] += result.skipped
+        self.stats["failed"] += result.failed
+        return result
+
+    async def _apply(self, task, link, ctx):
+        task_id, discord_id, guild_id, reason, attempts = task
+        try:
+            if link is None or not link[3]:
+                raise bulk.Skip(f"Discord ID {discord_id} is no longer verified")
+            try:
+                guild = await self.guild(int(guild_id))
+            except discord.NotFound:
+                raise bulk.Skip(f"Guild {guild_id} is no longer available")
+            apply = _appliers.get(reason, dd.assign_roles)
+            await apply(guild, discord_id, link[2], ctx, mutations.BACKGROUND)
+        except bulk.Skip:
+            db.complete_sync_task(task_id, leases.owner_id)
+            raise
+        except Exception as e:
+            retry_at = None
+            if attempts < max_attempts:
+                retry_at = time.time() + retry_backoff * 2 ** (attempts - 1)
+            db.fail_sync_task(task_id, leases.owner_id, repr(e), retry_at)
+            if retry_at is None and link is not None:
+                # The daemon recorded the new state when it queued the task;
+                # forget it so the role sync queues the user again later.
+                db.reset_user_state(link[0])
+            raise
+        db.complete_sync_task(task_id, leases.owner_id)
+
+
+async def run_worker(token, concurrency=None, batch_size=None):
+    """Logs in over REST and processes sync tasks until cancelled.
+
+    Args:
+        token (str): The bot token.
+        concurrency (int): The number of tasks applied at once.
+        batch_size (int): The number of tasks claimed at once.
+    """
+    gf.rest_only = True
+    db.init_db()
+    client = discord.Client(intents=discord.Intents.none())
+    await client.login(token)
+    print(f"Sync worker {leases.owner_id} started.")
+    try:
+        await SyncWorker(client, concurrency, batch_size).run()
+    finally:
+        await client.close()
+        await do.close()
+
+
+def main(argv=None):
+    """Runs a sync worker.
+
+    Args:
+        argv (list): Command line arguments, defaults to ``sys.argv[1:]``.
+    """
+    parser = argparse.ArgumentParser(description="Run a Democradroid sync worker.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=worker_concurrency,
+        help="Number of tasks applied at once",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=worker_batch_size,
+        help="Number of tasks claimed at once",
+    )
+    args = parser.parse_args(argv)
+
+    with open(".token", "r") as f:
+        token = f.read().strip()
+    asyncio.run(run_worker(token, args.concurrency, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()